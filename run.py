@@ -4,6 +4,10 @@
 import sys
 from pathlib import Path
 
+# asyncio.TaskGroup и ExceptionGroup появились в Python 3.11
+if sys.version_info < (3, 11):
+    sys.exit("Требуется Python 3.11 или новее")
+
 # Добавляем корневую директорию в Python path
 root_path = Path(__file__).parent
 sys.path.insert(0, str(root_path))
@@ -1,14 +1,42 @@
 """Клиент для взаимодействия с AnkiConnect API."""
 
+import asyncio
 import base64
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 
 import httpx
+import orjson
+import pybase64
 from loguru import logger
+from pydantic import TypeAdapter, ValidationError
 
 from .schemas import AnkiNote
 from .settings import ANKI_CONFIG
-from .utils import batch_items, retry_with_backoff
+from .utils import async_cached, retry_with_backoff
+
+# Метаданные колод и моделей не меняются за время прогона
+METADATA_CACHE_TTL = 300.0
+
+# Ответы крупнее этого размера (notesInfo по тысячам заметок) разбираются
+# в отдельном потоке, чтобы не останавливать event loop
+LARGE_RESPONSE_THRESHOLD = 256 * 1024
+
+# Ниже этого размера накладные расходы SIMD бэкенда не окупаются
+SIMD_BASE64_THRESHOLD = 1024
+
+# Сколько действий notesInfo (по batch_size заметок) упаковывается в один
+# multi: сбой или таймаут запроса теряет только эту часть колоды
+NOTES_INFO_ACTIONS_PER_MULTI = 10
+
+# Заметки батча notesInfo валидируются одним вызовом pydantic-core
+_NOTES_ADAPTER = TypeAdapter(List[AnkiNote])
+
+
+def encode_media(data: bytes) -> str:
+    """Закодировать медиа данные в base64 строку для AnkiConnect."""
+    if len(data) < SIMD_BASE64_THRESHOLD:
+        return base64.b64encode(data).decode('utf-8')
+    return pybase64.b64encode_as_string(data)
 
 
 class AnkiConnectError(Exception):
@@ -19,10 +47,48 @@ class AnkiConnectError(Exception):
 class AnkiClient:
     """Клиент для работы с Anki через AnkiConnect."""
     
-    def __init__(self):
-        self.url = ANKI_CONFIG.url
+    def __init__(self, url: Optional[str] = None):
+        self.url = self._normalize_url(url or ANKI_CONFIG.url)
         self.timeout = ANKI_CONFIG.timeout
         self.batch_size = ANKI_CONFIG.batch_size
+        self.max_concurrency = ANKI_CONFIG.max_concurrency
+        self._client: Optional[httpx.AsyncClient] = None
+        # Общий лимит одновременных запросов ко всем методам клиента
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+    
+    async def __aenter__(self) -> "AnkiClient":
+        self._get_client()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+    
+    @staticmethod
+    def _normalize_url(url: str) -> str:
+        """Заменить localhost на 127.0.0.1: на Windows резолв localhost заметно тормозит."""
+        parsed = httpx.URL(url)
+        if parsed.host == "localhost":
+            parsed = parsed.copy_with(host="127.0.0.1")
+        return str(parsed)
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Получить общий HTTP клиент (создается при первом запросе)."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_keepalive_connections=32,
+                    max_connections=64
+                )
+            )
+        return self._client
+    
+    async def aclose(self):
+        """Закрыть HTTP клиент и освободить соединения."""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
     
     async def _request(self, action: str, **params) -> Any:
         """Базовый запрос к AnkiConnect."""
@@ -32,29 +98,87 @@ class AnkiClient:
             "params": params
         }
         
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            try:
-                response = await client.post(self.url, json=payload)
-                response.raise_for_status()
-                
-                data = response.json()
-                if data.get("error"):
-                    raise AnkiConnectError(f"Anki error in {action}: {data['error']}")
-                
-                return data.get("result")
-            except httpx.RequestError as e:
-                raise AnkiConnectError(f"Ошибка соединения с Anki: {e}")
-            except Exception as e:
-                raise AnkiConnectError(f"Ошибка запроса {action}: {e}")
+        try:
+            async with self._semaphore:
+                response = await self._get_client().post("", json=payload)
+            response.raise_for_status()
+            
+            content = response.content
+            if len(content) > LARGE_RESPONSE_THRESHOLD:
+                data = await asyncio.to_thread(orjson.loads, content)
+            else:
+                data = orjson.loads(content)
+            if data.get("error"):
+                raise AnkiConnectError(f"Anki error in {action}: {data['error']}")
+            
+            return data.get("result")
+        except httpx.RequestError as e:
+            raise AnkiConnectError(f"Ошибка соединения с Anki: {e}")
+        except Exception as e:
+            raise AnkiConnectError(f"Ошибка запроса {action}: {e}")
     
     async def _multi_request(self, actions: List[Dict[str, Any]]) -> List[Any]:
         """Множественный запрос через action 'multi'."""
         return await self._request("multi", actions=actions)
     
+    @staticmethod
+    def _is_multi_error(result: Any) -> bool:
+        """Проверить, завершилось ли действие внутри multi ошибкой."""
+        return isinstance(result, dict) and bool(result.get("error"))
+    
+    async def _imap_batches(
+        self,
+        items: List[Any],
+        fn: Callable[[List[Any]], Awaitable[Any]],
+        concurrency: Optional[int] = None,
+        batch_size: Optional[int] = None
+    ) -> AsyncIterator[Tuple[int, Any]]:
+        """
+        Выполнить fn над батчами items параллельно.
+        
+        Батчи (по batch_size, по умолчанию self.batch_size) нарезаются лениво,
+        одновременно в работе не больше concurrency штук.
+        
+        Yields:
+            (смещение батча в items, результат fn) по мере готовности
+        """
+        concurrency = concurrency or self.max_concurrency
+        batch_size = batch_size or self.batch_size
+        offsets = iter(range(0, len(items), batch_size))
+        
+        async def run(offset: int) -> Tuple[int, Any]:
+            return offset, await fn(items[offset:offset + batch_size])
+        
+        pending = set()
+        for offset in offsets:
+            pending.add(asyncio.create_task(run(offset)))
+            if len(pending) >= concurrency:
+                break
+        
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    next_offset = next(offsets, None)
+                    if next_offset is not None:
+                        pending.add(asyncio.create_task(run(next_offset)))
+                    yield task.result()
+        finally:
+            # При досрочном выходе (break у вызывающего, ошибка, отмена)
+            # дожидаемся отмененных задач, чтобы их исключения не потерялись
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+    
+    @async_cached(ttl=METADATA_CACHE_TTL)
     async def get_deck_names(self) -> List[str]:
         """Получить список всех колод."""
         return await retry_with_backoff(self._request, "deckNames")
     
+    @async_cached(ttl=METADATA_CACHE_TTL)
     async def get_deck_names_and_ids(self) -> Dict[str, int]:
         """Получить словарь колод: имя -> ID."""
         return await retry_with_backoff(self._request, "deckNamesAndIds")
@@ -64,68 +188,113 @@ class AnkiClient:
         return await retry_with_backoff(self._request, "findNotes", query=query)
     
     async def get_notes_info(self, note_ids: List[int]) -> List[AnkiNote]:
-        """Получить информацию о заметках."""
+        """Получить информацию о заметках (в порядке note_ids)."""
         if not note_ids:
             return []
         
-        # Обрабатываем батчами для больших списков
-        all_notes = []
-        batches = batch_items(note_ids, self.batch_size)
-        
-        for batch in batches:
+        async def fetch_chunk(chunk: List[int]) -> List[AnkiNote]:
+            # Батчи notesInfo части колоды упаковываем в один multi запрос
+            actions = [
+                {
+                    "action": "notesInfo",
+                    "params": {"notes": chunk[offset:offset + self.batch_size]}
+                }
+                for offset in range(0, len(chunk), self.batch_size)
+            ]
+            
             try:
-                raw_notes = await retry_with_backoff(
-                    self._request, "notesInfo", notes=batch
-                )
+                raw_batches = await retry_with_backoff(self._multi_request, actions)
+            except Exception as e:
+                logger.error(f"Ошибка получения информации о {len(chunk)} заметках: {e}")
+                return []
+            
+            notes = []
+            for raw_notes in raw_batches:
+                # Ошибка отдельного действия в multi приходит как {"result": None, "error": ...}
+                if self._is_multi_error(raw_notes):
+                    logger.error(f"Ошибка получения информации о заметках: {raw_notes['error']}")
+                    continue
                 
-                for note_data in raw_notes:
-                    fields = {}
-                    for field_name, field_data in note_data.get("fields", {}).items():
-                        fields[field_name] = field_data.get("value", "")
-                    
-                    note = AnkiNote(
-                        note_id=note_data["noteId"],
-                        model_name=note_data.get("modelName", ""),
-                        deck_name=note_data.get("deckName", ""),
-                        fields=fields,
-                        tags=note_data.get("tags", [])
-                    )
-                    all_notes.append(note)
-                    
+                notes.extend(self._parse_notes(raw_notes))
+            return notes
+        
+        # Части колоды запрашиваются параллельно и собираются по смещению
+        chunks: Dict[int, List[AnkiNote]] = {}
+        async for offset, notes in self._imap_batches(
+            note_ids,
+            fetch_chunk,
+            batch_size=self.batch_size * NOTES_INFO_ACTIONS_PER_MULTI
+        ):
+            chunks[offset] = notes
+        
+        return [note for offset in sorted(chunks) for note in chunks[offset]]
+    
+    async def iter_notes_info(self, note_ids: List[int]) -> AsyncIterator[List[AnkiNote]]:
+        """
+        Получать информацию о заметках батчами по мере готовности.
+        
+        Батчи notesInfo запрашиваются параллельно, порядок не сохраняется.
+        """
+        async def fetch_batch(batch: List[int]) -> List[Dict[str, Any]]:
+            try:
+                return await retry_with_backoff(self._request, "notesInfo", notes=batch)
             except Exception as e:
                 logger.error(f"Ошибка получения информации о заметках: {e}")
-                continue
+                return []
         
-        return all_notes
+        async for _, raw_notes in self._imap_batches(note_ids, fetch_batch):
+            yield self._parse_notes(raw_notes)
     
-    async def update_note_fields(self, note_id: int, fields: Dict[str, str]) -> bool:
-        """Обновить поля заметки."""
-        try:
-            await retry_with_backoff(
-                self._request, "updateNoteFields",
-                note={"id": note_id, "fields": fields}
-            )
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка обновления полей заметки {note_id}: {e}")
-            return False
+    @staticmethod
+    def _note_payload(note_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Поля AnkiNote из записи ответа notesInfo."""
+        return {
+            "note_id": note_data["noteId"],
+            "model_name": note_data.get("modelName", ""),
+            "deck_name": note_data.get("deckName", ""),
+            "fields": {
+                field_name: field_data.get("value", "")
+                for field_name, field_data in note_data.get("fields", {}).items()
+            },
+            "tags": note_data.get("tags", [])
+        }
     
-    async def update_note_tags(self, note_id: int, tags: List[str]) -> bool:
-        """Обновить теги заметки."""
+    @classmethod
+    def _parse_notes(cls, raw_notes: List[Dict[str, Any]]) -> List[AnkiNote]:
+        """Преобразовать ответ notesInfo в список AnkiNote."""
         try:
-            await retry_with_backoff(
-                self._request, "updateNote",
-                note={"id": note_id, "tags": tags}
-            )
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка обновления тегов заметки {note_id}: {e}")
-            return False
+            return _NOTES_ADAPTER.validate_python([
+                cls._note_payload(note_data) for note_data in raw_notes
+            ])
+        except (ValidationError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Некорректные данные в ответе notesInfo, разбираем заметки по одной: {e}")
+        
+        # Медленный путь: отбрасываем только некорректные заметки батча
+        notes = []
+        for note_data in raw_notes:
+            try:
+                notes.append(AnkiNote.model_validate(cls._note_payload(note_data)))
+            except (ValidationError, KeyError, TypeError, AttributeError) as e:
+                logger.error(f"Пропущена некорректная заметка из notesInfo: {e}")
+        return notes
+    
+    async def update_note(
+        self,
+        note_id: int,
+        fields: Dict[str, str],
+        tags: Optional[List[str]] = None
+    ) -> bool:
+        """Обновить поля и теги заметки одним запросом multi."""
+        update: Dict[str, Any] = {"note_id": note_id, "fields": fields}
+        if tags:
+            update["tags"] = tags
+        results = await self.batch_update_notes([update])
+        return results[0]
     
     async def store_media_file(self, filename: str, data: bytes) -> bool:
         """Сохранить медиа файл в Anki."""
         try:
-            b64_data = base64.b64encode(data).decode('utf-8')
+            b64_data = encode_media(data)
             await retry_with_backoff(
                 self._request, "storeMediaFile",
                 filename=filename, data=b64_data
@@ -143,12 +312,12 @@ class AnkiClient:
         if not updates:
             return []
         
-        results = []
-        batches = batch_items(updates, self.batch_size)
-        
-        for batch in batches:
+        async def send_batch(batch: List[Dict[str, Any]]) -> List[bool]:
             actions = []
+            # Сколько действий multi приходится на каждое обновление
+            action_counts = []
             for update in batch:
+                count = 0
                 if "fields" in update:
                     actions.append({
                         "action": "updateNoteFields",
@@ -159,6 +328,7 @@ class AnkiClient:
                             }
                         }
                     })
+                    count += 1
                 
                 if "tags" in update:
                     actions.append({
@@ -170,15 +340,31 @@ class AnkiClient:
                             }
                         }
                     })
+                    count += 1
+                action_counts.append(count)
             
             try:
                 batch_results = await retry_with_backoff(self._multi_request, actions)
-                # Каждый запрос в multi возвращает результат
-                results.extend([True] * len(batch))
             except Exception as e:
                 logger.error(f"Ошибка батчевого обновления: {e}")
-                results.extend([False] * len(batch))
+                return [False] * len(batch)
+            
+            # Обновление успешно, только если успешны все его действия
+            results = []
+            position = 0
+            for update, count in zip(batch, action_counts):
+                item_results = batch_results[position:position + count]
+                position += count
+                ok = not any(self._is_multi_error(r) for r in item_results)
+                if not ok:
+                    logger.error(f"Ошибка обновления заметки {update['note_id']}: {item_results}")
+                results.append(ok)
+            return results
         
+        # Батчи отправляются параллельно, результаты раскладываются по смещению
+        results = [False] * len(updates)
+        async for offset, batch_result in self._imap_batches(updates, send_batch):
+            results[offset:offset + len(batch_result)] = batch_result
         return results
     
     async def batch_store_media(
@@ -189,40 +375,76 @@ class AnkiClient:
         if not media_files:
             return []
         
-        results = []
-        batches = batch_items(media_files, self.batch_size)
-        
-        for batch in batches:
-            actions = []
-            for media in batch:
-                b64_data = base64.b64encode(media["data"]).decode('utf-8')
-                actions.append({
+        async def send_batch(batch: List[Dict[str, Any]]) -> List[bool]:
+            # Кодирование тяжелое для CPU - выносим из event loop в потоки
+            encoded = await asyncio.gather(*[
+                asyncio.to_thread(encode_media, media["data"])
+                for media in batch
+            ])
+            actions = [
+                {
                     "action": "storeMediaFile",
                     "params": {
                         "filename": media["filename"],
                         "data": b64_data
                     }
-                })
+                }
+                for media, b64_data in zip(batch, encoded)
+            ]
             
             try:
-                await retry_with_backoff(self._multi_request, actions)
-                results.extend([True] * len(batch))
+                batch_results = await retry_with_backoff(self._multi_request, actions)
             except Exception as e:
                 logger.error(f"Ошибка батчевого сохранения медиа: {e}")
-                results.extend([False] * len(batch))
+                return [False] * len(batch)
+            
+            return [not self._is_multi_error(r) for r in batch_results]
         
+        results = [False] * len(media_files)
+        async for offset, batch_result in self._imap_batches(media_files, send_batch):
+            results[offset:offset + len(batch_result)] = batch_result
         return results
     
+    @async_cached(ttl=METADATA_CACHE_TTL)
     async def get_model_names(self) -> List[str]:
         """Получить список типов заметок."""
         return await retry_with_backoff(self._request, "modelNames")
     
+    @async_cached(ttl=METADATA_CACHE_TTL)
     async def get_model_field_names(self, model_name: str) -> List[str]:
         """Получить поля типа заметки."""
         return await retry_with_backoff(
             self._request, "modelFieldNames", modelName=model_name
         )
     
+    async def get_collection_metadata(self, model_names: List[str]) -> Dict[str, Any]:
+        """
+        Получить колоды, типы заметок и поля указанных типов одним multi запросом.
+        
+        Returns:
+            {"decks": [...], "models": [...], "fields": {тип: [поля]}}
+            Типы, отсутствующие в Anki, в "fields" не попадают.
+        """
+        actions = [{"action": "deckNames"}, {"action": "modelNames"}] + [
+            {"action": "modelFieldNames", "params": {"modelName": name}}
+            for name in model_names
+        ]
+        
+        decks, models, *field_lists = await retry_with_backoff(self._multi_request, actions)
+        for action, result in (("deckNames", decks), ("modelNames", models)):
+            if self._is_multi_error(result):
+                raise AnkiConnectError(f"Anki error in {action}: {result['error']}")
+        
+        return {
+            "decks": decks,
+            "models": models,
+            "fields": {
+                name: fields
+                for name, fields in zip(model_names, field_lists)
+                if not self._is_multi_error(fields)
+            }
+        }
+    
     async def check_connection(self) -> bool:
         """Проверить соединение с Anki."""
         try:
@@ -1,16 +1,25 @@
 """Модуль для кеширования данных и состояний."""
 
-import json
+import asyncio
+import os
+import sys
 import time
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, FrozenSet, List, Optional, Set
 
 import aiofiles
+import orjson
 from loguru import logger
+from pydantic import TypeAdapter
 
 from .schemas import AnkiNote, CacheEntry, LLMWordData, ProcessingResult
 from .settings import CACHE_CONFIG
-from .utils import generate_cache_key
+from .utils import generate_cache_key, generate_llm_cache_key
+
+# Адаптеры сериализуют модели сразу в JSON байты, без промежуточных dict
+_NOTES_ADAPTER = TypeAdapter(List[AnkiNote])
+_OPENAI_ENTRY_ADAPTER = TypeAdapter(LLMWordData)
+_PROCESSING_ENTRY_ADAPTER = TypeAdapter(ProcessingResult)
 
 
 class CacheManager:
@@ -20,24 +29,44 @@ class CacheManager:
         self.cache_dir = Path(CACHE_CONFIG.dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         
+        # Кеш читается только программой - отступы лишь увеличивают объем
+        self._indent = 2 if CACHE_CONFIG.pretty else None
+        self._orjson_option = orjson.OPT_INDENT_2 if CACHE_CONFIG.pretty else 0
+        
         # Пути к файлам кеша
         self.notes_cache_path = self.cache_dir / "notes_raw.json"
-        self.openai_cache_path = self.cache_dir / "openai_results.json"
+        self.openai_cache_path = self.cache_dir / "openai_results.jsonl"
         self.freq_cache_path = self.cache_dir / "freq.json"
-        self.processing_cache_path = self.cache_dir / "processing_results.json"
+        self.processing_cache_path = self.cache_dir / "processing_results.jsonl"
+        
+        # Снимки в прежнем формате - читаются, только если журнала еще нет
+        self.legacy_openai_cache_path = self.cache_dir / "openai_results.json"
+        self.legacy_processing_cache_path = self.cache_dir / "processing_results.json"
         
         # In-memory кеши
         self._notes_cache: Dict[str, AnkiNote] = {}
         self._openai_cache: Dict[str, LLMWordData] = {}
         self._freq_cache: Dict[str, str] = {}  # word -> freq_rank
         self._processing_cache: Dict[str, ProcessingResult] = {}
+        
+        # Ключи успешно обработанных заметок для O(1) проверки
+        self._processed_keys: Set[str] = set()
+        
+        # Ключи, измененные с последнего сохранения журнала
+        self._openai_dirty: Set[str] = set()
+        self._processing_dirty: Set[str] = set()
+        # Дозапись журналов идет и периодически во время обработки, и в конце
+        self._journal_lock = asyncio.Lock()
     
     async def load_all_caches(self):
         """Загрузить все кеши в память."""
-        await self._load_notes_cache()
-        await self._load_openai_cache()
-        await self._load_freq_cache()
-        await self._load_processing_cache()
+        # Файлы независимы - читаем параллельно через пул потоков aiofiles
+        await asyncio.gather(
+            self._load_notes_cache(),
+            self._load_openai_cache(),
+            self._load_freq_cache(),
+            self._load_processing_cache()
+        )
         
         logger.info(
             f"Кеши загружены: notes={len(self._notes_cache)}, "
@@ -50,28 +79,131 @@ class CacheManager:
         """Загрузить кеш заметок."""
         try:
             if self.notes_cache_path.exists():
-                async with aiofiles.open(self.notes_cache_path, 'r', encoding='utf-8') as f:
-                    data = json.loads(await f.read())
+                async with aiofiles.open(self.notes_cache_path, 'rb') as f:
+                    data = orjson.loads(await f.read())
                     
+                # Данные записаны этим же процессом - повторная валидация не нужна
                 self._notes_cache = {
-                    note_data["note_id"]: AnkiNote(**note_data)
+                    str(note_data["note_id"]): AnkiNote.model_construct(**note_data)
                     for note_data in data
                 }
         except Exception as e:
             logger.warning(f"Ошибка загрузки кеша заметок: {e}")
             self._notes_cache = {}
     
+    async def _read_journal(self, path: Path) -> Dict[str, Any]:
+        """Прочитать журнал кеша: по записи {"key", "value"} на строку, побеждает последняя."""
+        async with aiofiles.open(path, 'rb') as f:
+            raw = await f.read()
+        
+        entries = {}
+        for line in raw.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # Недописанная строка после аварийного завершения
+                logger.warning(f"Пропущена поврежденная строка журнала {path.name}")
+                continue
+            entries[record["key"]] = record["value"]
+        
+        return entries
+    
+    async def _read_legacy_snapshot(self, path: Path, dirty: Set[str]) -> Dict[str, Any]:
+        """Прочитать снимок старого формата и пометить записи для переноса в журнал."""
+        async with aiofiles.open(path, 'rb') as f:
+            data = orjson.loads(await f.read())
+        
+        dirty.update(data)
+        return data
+    
+    @staticmethod
+    def _journal_line(key: str, value: Any, adapter: TypeAdapter) -> bytes:
+        """Сериализовать запись журнала в одну JSON строку."""
+        return b'{"key":' + orjson.dumps(key) + b',"value":' + adapter.dump_json(value) + b'}\n'
+    
+    async def _append_journal(
+        self,
+        path: Path,
+        cache: Dict[str, Any],
+        dirty: Set[str],
+        adapter: TypeAdapter
+    ) -> int:
+        """Дописать в журнал только измененные записи."""
+        # Снимок и запись - под общей с перезаписью журнала блокировкой:
+        # иначе дозапись могла бы уйти в файл, который заменяет _rewrite_journal
+        async with self._journal_lock:
+            keys = [key for key in dirty if key in cache]
+            # Забираем ключи до await, чтобы не потерять записи, добавленные во время записи
+            dirty.clear()
+            if not keys:
+                return 0
+            
+            payload = b"".join(self._journal_line(key, cache[key], adapter) for key in keys)
+            try:
+                async with aiofiles.open(path, 'ab') as f:
+                    await f.write(payload)
+                    await f.flush()
+                    await asyncio.to_thread(os.fsync, f.fileno())
+            except BaseException:
+                # В том числе при отмене: записи допишет следующее сохранение
+                dirty.update(keys)
+                raise
+        
+        return len(keys)
+    
+    async def _rewrite_journal(
+        self,
+        path: Path,
+        cache: Dict[str, Any],
+        dirty: Set[str],
+        adapter: TypeAdapter
+    ):
+        """
+        Переписать журнал целиком (нужно после удаления записей).
+        
+        Вызывается под _journal_lock, иначе параллельная дозапись попала бы
+        в старый файл и пропала при os.replace.
+        """
+        payload = b"".join(
+            self._journal_line(key, value, adapter) for key, value in cache.items()
+        )
+        # Снимок уже содержит все записи кеша - сбрасываем их пометки в том же
+        # синхронном шаге. Помеченные во время записи файла остаются
+        pending = set(dirty)
+        dirty.clear()
+        try:
+            await self._write_atomic(path, payload)
+        except BaseException:
+            dirty.update(pending)
+            raise
+    
+    async def _write_atomic(self, path: Path, payload: bytes):
+        """Записать файл атомарно: во временный файл, fsync, затем os.replace."""
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        async with aiofiles.open(tmp_path, 'wb') as f:
+            await f.write(payload)
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+        # При сбое на диске остается либо старый, либо новый файл целиком
+        os.replace(tmp_path, path)
+    
     async def _load_openai_cache(self):
         """Загрузить кеш OpenAI результатов."""
         try:
+            data = {}
             if self.openai_cache_path.exists():
-                async with aiofiles.open(self.openai_cache_path, 'r', encoding='utf-8') as f:
-                    data = json.loads(await f.read())
-                    
-                self._openai_cache = {
-                    key: LLMWordData(**value)
-                    for key, value in data.items()
-                }
+                data = await self._read_journal(self.openai_cache_path)
+            elif self.legacy_openai_cache_path.exists():
+                data = await self._read_legacy_snapshot(
+                    self.legacy_openai_cache_path, self._openai_dirty
+                )
+            
+            self._openai_cache = {
+                key: LLMWordData.model_construct(**value)
+                for key, value in data.items()
+            }
         except Exception as e:
             logger.warning(f"Ошибка загрузки кеша OpenAI: {e}")
             self._openai_cache = {}
@@ -80,8 +212,14 @@ class CacheManager:
         """Загрузить кеш частотности."""
         try:
             if self.freq_cache_path.exists():
-                async with aiofiles.open(self.freq_cache_path, 'r', encoding='utf-8') as f:
-                    self._freq_cache = json.loads(await f.read())
+                async with aiofiles.open(self.freq_cache_path, 'rb') as f:
+                    data = orjson.loads(await f.read())
+                
+                # Значений рангов немного - интернируем, чтобы не хранить дубликаты строк
+                self._freq_cache = {
+                    word: sys.intern(freq_rank)
+                    for word, freq_rank in data.items()
+                }
         except Exception as e:
             logger.warning(f"Ошибка загрузки кеша частотности: {e}")
             self._freq_cache = {}
@@ -89,84 +227,113 @@ class CacheManager:
     async def _load_processing_cache(self):
         """Загрузить кеш результатов обработки."""
         try:
+            data = {}
             if self.processing_cache_path.exists():
-                async with aiofiles.open(self.processing_cache_path, 'r', encoding='utf-8') as f:
-                    data = json.loads(await f.read())
-                    
-                self._processing_cache = {
-                    key: ProcessingResult(**value)
-                    for key, value in data.items()
-                }
+                data = await self._read_journal(self.processing_cache_path)
+            elif self.legacy_processing_cache_path.exists():
+                data = await self._read_legacy_snapshot(
+                    self.legacy_processing_cache_path, self._processing_dirty
+                )
+            
+            self._processing_cache = {
+                key: ProcessingResult.model_construct(**value)
+                for key, value in data.items()
+            }
+            self._processed_keys = {
+                key for key, result in self._processing_cache.items() if result.success
+            }
         except Exception as e:
             logger.warning(f"Ошибка загрузки кеша обработки: {e}")
             self._processing_cache = {}
+            self._processed_keys = set()
     
     async def save_notes_cache(self, notes: List[AnkiNote]):
         """Сохранить кеш заметок."""
         self._notes_cache = {str(note.note_id): note for note in notes}
         
         try:
-            data = [note.model_dump() for note in notes]
-            async with aiofiles.open(self.notes_cache_path, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(data, ensure_ascii=False, indent=2))
+            payload = _NOTES_ADAPTER.dump_json(notes, indent=self._indent)
+            await self._write_atomic(self.notes_cache_path, payload)
             
             logger.debug(f"Кеш заметок сохранен: {len(notes)} записей")
         except Exception as e:
             logger.error(f"Ошибка сохранения кеша заметок: {e}")
     
     async def save_openai_cache(self):
-        """Сохранить кеш OpenAI результатов."""
+        """Сохранить новые записи кеша OpenAI результатов."""
         try:
-            data = {
-                key: value.model_dump()
-                for key, value in self._openai_cache.items()
-            }
+            written = await self._append_journal(
+                self.openai_cache_path,
+                self._openai_cache,
+                self._openai_dirty,
+                _OPENAI_ENTRY_ADAPTER
+            )
             
-            async with aiofiles.open(self.openai_cache_path, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(data, ensure_ascii=False, indent=2))
-            
-            logger.debug(f"Кеш OpenAI сохранен: {len(data)} записей")
+            logger.debug(f"Кеш OpenAI сохранен: {written} новых записей")
         except Exception as e:
             logger.error(f"Ошибка сохранения кеша OpenAI: {e}")
     
     async def save_freq_cache(self):
         """Сохранить кеш частотности."""
         try:
-            async with aiofiles.open(self.freq_cache_path, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(self._freq_cache, ensure_ascii=False, indent=2))
+            payload = orjson.dumps(self._freq_cache, option=self._orjson_option)
+            await self._write_atomic(self.freq_cache_path, payload)
             
             logger.debug(f"Кеш частотности сохранен: {len(self._freq_cache)} записей")
         except Exception as e:
             logger.error(f"Ошибка сохранения кеша частотности: {e}")
     
     async def save_processing_cache(self):
-        """Сохранить кеш результатов обработки."""
+        """Сохранить новые записи кеша результатов обработки."""
         try:
-            data = {
-                key: value.model_dump()
-                for key, value in self._processing_cache.items()
-            }
-            
-            async with aiofiles.open(self.processing_cache_path, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(data, ensure_ascii=False, indent=2))
+            written = await self._append_journal(
+                self.processing_cache_path,
+                self._processing_cache,
+                self._processing_dirty,
+                _PROCESSING_ENTRY_ADAPTER
+            )
             
-            logger.debug(f"Кеш обработки сохранен: {len(data)} записей")
+            logger.debug(f"Кеш обработки сохранен: {written} новых записей")
         except Exception as e:
             logger.error(f"Ошибка сохранения кеша обработки: {e}")
     
+    async def save_all(self):
+        """Сохранить все изменяемые за прогон кеши параллельно."""
+        # Кеш заметок пишется при загрузке колоды и за прогон не меняется.
+        # Ошибки записи методы логируют сами, так что TaskGroup прервется
+        # только на отмене или непредвиденном исключении - и не скроет его
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self.save_openai_cache())
+            tg.create_task(self.save_freq_cache())
+            tg.create_task(self.save_processing_cache())
+    
     def get_cached_note(self, note_id: int) -> Optional[AnkiNote]:
         """Получить заметку из кеша."""
         return self._notes_cache.get(str(note_id))
     
-    def get_cached_openai_data(self, word: str, sentence: str) -> Optional[LLMWordData]:
+    def get_cached_openai_data(
+        self, 
+        word: str, 
+        sentence: str, 
+        model: str, 
+        system_prompt: str
+    ) -> Optional[LLMWordData]:
         """Получить данные OpenAI из кеша."""
-        cache_key = generate_cache_key(word.lower(), sentence)
+        cache_key = generate_llm_cache_key(word, sentence, model, system_prompt)
         return self._openai_cache.get(cache_key)
     
-    def set_cached_openai_data(self, word: str, sentence: str, data: LLMWordData):
+    def set_cached_openai_data(
+        self, 
+        word: str, 
+        sentence: str, 
+        model: str, 
+        system_prompt: str, 
+        data: LLMWordData
+    ):
         """Сохранить данные OpenAI в кеш."""
-        cache_key = generate_cache_key(word.lower(), sentence)
+        cache_key = generate_llm_cache_key(word, sentence, model, system_prompt)
         self._openai_cache[cache_key] = data
+        self._openai_dirty.add(cache_key)
     
     def get_cached_frequency(self, word: str, lemma: str = None) -> Optional[str]:
         """Получить частотность из кеша."""
@@ -176,7 +343,7 @@ class CacheManager:
     def set_cached_frequency(self, word: str, freq_rank: str, lemma: str = None):
         """Сохранить частотность в кеш."""
         search_key = (lemma or word).lower()
-        self._freq_cache[search_key] = freq_rank
+        self._freq_cache[search_key] = sys.intern(freq_rank)
     
     def get_cached_processing_result(self, note_id: int, fields_hash: str) -> Optional[ProcessingResult]:
         """Получить результат обработки из кеша."""
@@ -192,14 +359,18 @@ class CacheManager:
         """Сохранить результат обработки в кеш."""
         cache_key = f"{note_id}_{fields_hash}"
         self._processing_cache[cache_key] = result
+        self._processing_dirty.add(cache_key)
+        if result.success:
+            self._processed_keys.add(cache_key)
+        else:
+            self._processed_keys.discard(cache_key)
     
     def is_note_processed(self, note_id: int, expression: str, sentence: str) -> bool:
         """Проверить, была ли заметка обработана."""
         cache_key = generate_cache_key(str(note_id), expression, sentence)
-        result = self._processing_cache.get(cache_key)
-        return result is not None and result.success
+        return cache_key in self._processed_keys
     
-    def should_regenerate_field(self, field_name: str, force_regenerate: List[str]) -> bool:
+    def should_regenerate_field(self, field_name: str, force_regenerate: FrozenSet[str]) -> bool:
         """Проверить, нужно ли перегенерировать поле."""
         return field_name in force_regenerate or "all" in force_regenerate
     
@@ -208,20 +379,31 @@ class CacheManager:
         cutoff_time = time.time() - (max_age_days * 24 * 60 * 60)
         cleaned = 0
         
-        # Очищаем кеш обработки по времени
-        to_remove = []
-        for key, result in self._processing_cache.items():
-            # Если в результате есть временная метка и она старая
-            if hasattr(result, 'created_at') and result.created_at < cutoff_time:
-                to_remove.append(key)
-        
-        for key in to_remove:
-            del self._processing_cache[key]
-            cleaned += 1
-        
-        if cleaned > 0:
-            logger.info(f"Очищено {cleaned} старых записей кеша")
-            await self.save_processing_cache()
+        # Под блокировкой журнала: периодическая дозапись не должна идти
+        # одновременно с перезаписью файла
+        async with self._journal_lock:
+            # Очищаем кеш обработки по времени
+            to_remove = []
+            for key, result in self._processing_cache.items():
+                # Записи без временной метки не трогаем
+                created_at = getattr(result, 'created_at', None)
+                if created_at is not None and created_at < cutoff_time:
+                    to_remove.append(key)
+            
+            for key in to_remove:
+                del self._processing_cache[key]
+                self._processed_keys.discard(key)
+                cleaned += 1
+            
+            if cleaned > 0:
+                logger.info(f"Очищено {cleaned} старых записей кеша")
+                # Удаление нельзя дописать в журнал - переписываем его целиком
+                await self._rewrite_journal(
+                    self.processing_cache_path,
+                    self._processing_cache,
+                    self._processing_dirty,
+                    _PROCESSING_ENTRY_ADAPTER
+                )
     
     def get_cache_stats(self) -> Dict[str, Any]:
         """Получить статистику кеша."""
@@ -241,11 +423,20 @@ class CacheManager:
     
     def _get_cache_dir_size(self) -> float:
         """Получить размер директории кеша в МБ."""
+        def walk(path: str) -> int:
+            # DirEntry кеширует тип и stat из чтения директории - без лишних syscall
+            size = 0
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+                    elif entry.is_dir(follow_symlinks=False):
+                        size += walk(entry.path)
+            return size
+        
         total_size = 0
         try:
-            for file_path in self.cache_dir.rglob("*"):
-                if file_path.is_file():
-                    total_size += file_path.stat().st_size
+            total_size = walk(str(self.cache_dir))
         except Exception:
             pass
         
@@ -260,8 +451,10 @@ class CacheManager:
         
         if cache_type in ("all", "openai"):
             self._openai_cache.clear()
-            if self.openai_cache_path.exists():
-                self.openai_cache_path.unlink()
+            self._openai_dirty.clear()
+            for path in (self.openai_cache_path, self.legacy_openai_cache_path):
+                if path.exists():
+                    path.unlink()
         
         if cache_type in ("all", "freq"):
             self._freq_cache.clear()
@@ -270,7 +463,10 @@ class CacheManager:
         
         if cache_type in ("all", "processing"):
             self._processing_cache.clear()
-            if self.processing_cache_path.exists():
-                self.processing_cache_path.unlink()
+            self._processed_keys.clear()
+            self._processing_dirty.clear()
+            for path in (self.processing_cache_path, self.legacy_processing_cache_path):
+                if path.exists():
+                    path.unlink()
         
         logger.info(f"Кеш '{cache_type}' очищен")
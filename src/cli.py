@@ -2,7 +2,8 @@
 
 import asyncio
 import sys
-from typing import List, Optional, Tuple
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
 from loguru import logger
 
@@ -12,53 +13,96 @@ from .pipeline import ProcessingPipeline
 from .settings import PROCESSING_CONFIG
 from .validators import NoteValidator
 
+# Допустимые ответы на вопросы y/n (сравниваются после casefold)
+_YES = frozenset({"y", "yes", "да"})
+_NO = frozenset({"n", "no", "нет"})
+
+
+async def _ainput(prompt: str = "") -> str:
+    """Прочитать строку из stdin, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    def set_result(value: str):
+        if not future.done():
+            future.set_result(value)
+    
+    def set_exception(error: BaseException):
+        if not future.done():
+            future.set_exception(error)
+    
+    def read():
+        try:
+            value = input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(set_exception, e)
+        else:
+            loop.call_soon_threadsafe(set_result, value)
+    
+    # Daemon-поток не держит процесс при выходе по Ctrl+C во время ожидания ввода
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+def _screen(*lines: str):
+    """Вывести экран целиком одной записью в stdout."""
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
 
 class CLIInterface:
     """Интерфейс командной строки."""
     
     def __init__(self):
         self.anki_client = AnkiClient()
-        self.pipeline = ProcessingPipeline()
+        self.pipeline = ProcessingPipeline(self.anki_client)
         self.validator = NoteValidator()
+        # Метаданные коллекции: колоды, типы заметок и их поля
+        self._meta: Dict[str, Any] = {}
+        # Списки для меню, собираются один раз после загрузки метаданных
+        self._decks: Tuple[str, ...] = ()
+        self._supported_types: Tuple[str, ...] = ()
     
     async def run(self):
         """Запуск главного интерфейса."""
         print("=== Anki English Learning Assistant ===\n")
         
-        try:
-            # Инициализация
-            await self._initialize()
-            
-            # Выбор колоды
-            deck_name = await self._select_deck()
-            if not deck_name:
-                return
-            
-            # Выбор типа заметки
-            note_type_name = await self._select_note_type(deck_name)
-            if not note_type_name:
-                return
-            
-            # Подтверждение конфигурации
-            confirmed = await self._confirm_configuration(deck_name, note_type_name)
-            if not confirmed:
-                return
-            
-            # Превью и валидация
-            preview_ok = await self._show_preview(deck_name, note_type_name)
-            if not preview_ok:
-                return
-            
-            # Запуск обработки
-            await self._run_processing(deck_name, note_type_name)
-            
-        except KeyboardInterrupt:
-            print("\nОбработка прервана пользователем")
-        except Exception as e:
-            logger.error(f"Критическая ошибка: {e}")
-            print(f"Критическая ошибка: {e}")
-        finally:
-            print("Завершение работы...")
+        async with self.anki_client:
+            try:
+                # Инициализация
+                await self._initialize()
+                
+                # Выбор колоды
+                deck_name = await self._select_deck()
+                if not deck_name:
+                    return
+                
+                # Выбор типа заметки
+                note_type_name = await self._select_note_type(deck_name)
+                if not note_type_name:
+                    return
+                
+                # Подтверждение конфигурации
+                confirmed = await self._confirm_configuration(deck_name, note_type_name)
+                if not confirmed:
+                    return
+                
+                # Превью и валидация
+                preview_ok = await self._show_preview(deck_name, note_type_name)
+                if not preview_ok:
+                    return
+                
+                # Запуск обработки
+                await self._run_processing(deck_name, note_type_name)
+                
+            except KeyboardInterrupt:
+                print("\nОбработка прервана пользователем")
+            except Exception as e:
+                logger.error("Критическая ошибка: {}", e)
+                print(f"Критическая ошибка: {e}")
+            finally:
+                print("Завершение работы...")
+                await self.pipeline.aclose()
     
     async def _initialize(self):
         """Инициализация системы."""
@@ -71,6 +115,16 @@ class CLIInterface:
                 "Убедитесь, что Anki запущен и AnkiConnect установлен."
             )
         
+        # Колоды, типы заметок и поля - одним запросом для всех меню
+        self._meta = await self.anki_client.get_collection_metadata(
+            list(NOTE_TYPE_CONFIGS)
+        )
+        self._decks = tuple(sorted(self._meta["decks"]))
+        self._supported_types = tuple(sorted(
+            note_type for note_type in self._meta["models"]
+            if note_type in NOTE_TYPE_CONFIGS
+        ))
+        
         # Инициализируем пайплайн
         await self.pipeline.initialize()
         
@@ -78,20 +132,20 @@ class CLIInterface:
     
     async def _select_deck(self) -> Optional[str]:
         """Выбор колоды."""
-        print("Получение списка колод...")
-        decks = await self.anki_client.get_deck_names()
+        decks = self._decks
         
         if not decks:
             print("Ошибка: Не найдено ни одной колоды")
             return None
         
-        print(f"\nДоступные колоды ({len(decks)}):")
-        for i, deck in enumerate(decks, 1):
-            print(f"  {i}. {deck}")
+        _screen(
+            f"\nДоступные колоды ({len(decks)}):",
+            *(f"  {i}. {deck}" for i, deck in enumerate(decks, 1))
+        )
         
         while True:
             try:
-                choice = input(f"\nВыберите колоду (1-{len(decks)}) или 'q' для выхода: ").strip()
+                choice = (await _ainput(f"\nВыберите колоду (1-{len(decks)}) или 'q' для выхода: ")).strip()
                 
                 if choice.lower() == 'q':
                     return None
@@ -109,27 +163,24 @@ class CLIInterface:
     
     async def _select_note_type(self, deck_name: str) -> Optional[str]:
         """Выбор типа заметки."""
-        # Получаем доступные типы заметок
-        available_types = await self.anki_client.get_model_names()
-        
-        # Фильтруем только те, которые есть в конфигурации
-        supported_types = [
-            note_type for note_type in available_types 
-            if note_type in NOTE_TYPE_CONFIGS
-        ]
+        # Типы заметок Anki, которые есть в конфигурации
+        supported_types = self._supported_types
         
         if not supported_types:
-            print("Ошибка: Не найдено поддерживаемых типов заметок")
-            print(f"Поддерживаемые типы: {list(NOTE_TYPE_CONFIGS.keys())}")
+            _screen(
+                "Ошибка: Не найдено поддерживаемых типов заметок",
+                f"Поддерживаемые типы: {list(NOTE_TYPE_CONFIGS.keys())}"
+            )
             return None
         
-        print(f"Поддерживаемые типы заметок ({len(supported_types)}):")
-        for i, note_type in enumerate(supported_types, 1):
-            print(f"  {i}. {note_type}")
+        _screen(
+            f"Поддерживаемые типы заметок ({len(supported_types)}):",
+            *(f"  {i}. {note_type}" for i, note_type in enumerate(supported_types, 1))
+        )
         
         while True:
             try:
-                choice = input(f"\nВыберите тип заметки (1-{len(supported_types)}) или 'q' для выхода: ").strip()
+                choice = (await _ainput(f"\nВыберите тип заметки (1-{len(supported_types)}) или 'q' для выхода: ")).strip()
                 
                 if choice.lower() == 'q':
                     return None
@@ -149,35 +200,46 @@ class CLIInterface:
         """Подтверждение конфигурации."""
         config = NOTE_TYPE_CONFIGS[note_type_name]
         
-        print("=== КОНФИГУРАЦИЯ ОБРАБОТКИ ===")
-        print(f"Колода: {deck_name}")
-        print(f"Тип заметки: {note_type_name}")
-        print(f"Сухой прогон: {'Да' if PROCESSING_CONFIG.dry_run else 'Нет'}")
-        print(f"Пропуск аудио: {'Да' if PROCESSING_CONFIG.skip_audio else 'Нет'}")
-        print(f"Пропуск частотности: {'Да' if PROCESSING_CONFIG.skip_frequency else 'Нет'}")
-        print(f"Пропуск невалидных заметок: {'Да' if PROCESSING_CONFIG.skip_invalid_notes else 'Нет'}")
+        # Если все GENERATE поля отключены настройками, обрабатывать нечего
+        if not config.effective_generate_fields(PROCESSING_CONFIG):
+            print("Нечего обрабатывать: все GENERATE поля пропускаются настройками")
+            return False
+        
+        lines = [
+            "=== КОНФИГУРАЦИЯ ОБРАБОТКИ ===",
+            f"Колода: {deck_name}",
+            f"Тип заметки: {note_type_name}",
+            f"Сухой прогон: {'Да' if PROCESSING_CONFIG.dry_run else 'Нет'}",
+            f"Пропуск аудио: {'Да' if PROCESSING_CONFIG.skip_audio else 'Нет'}",
+            f"Пропуск частотности: {'Да' if PROCESSING_CONFIG.skip_frequency else 'Нет'}",
+            f"Пропуск невалидных заметок: {'Да' if PROCESSING_CONFIG.skip_invalid_notes else 'Нет'}"
+        ]
         
         if PROCESSING_CONFIG.force_regenerate:
-            print(f"Принудительная регенерация: {', '.join(PROCESSING_CONFIG.force_regenerate)}")
+            lines.append(f"Принудительная регенерация: {', '.join(PROCESSING_CONFIG.force_regenerate)}")
         
-        print(f"\nПоля для обработки:")
-        print(f"  INPUT (должны быть заполнены): {config.input_fields}")
-        print(f"  GENERATE (будут заполнены): {config.generate_fields}")
+        lines += [
+            f"\nПоля для обработки:",
+            f"  INPUT (должны быть заполнены): {config.input_fields}",
+            f"  GENERATE (будут заполнены): {config.generate_fields}"
+        ]
         
         # Проверяем совместимость полей
-        anki_fields = await self.anki_client.get_model_field_names(note_type_name)
+        anki_fields = self._meta["fields"].get(note_type_name, [])
         compatible, missing = self.validator.validate_note_type_compatibility(
             anki_fields, note_type_name
         )
         
         if not compatible:
-            print(f"\n⚠️  ПРЕДУПРЕЖДЕНИЕ: Отсутствующие поля в Anki: {missing}")
+            lines.append(f"\n⚠️  ПРЕДУПРЕЖДЕНИЕ: Отсутствующие поля в Anki: {missing}")
+        
+        _screen(*lines)
         
         while True:
-            choice = input("\nПродолжить обработку? (y/n): ").strip().lower()
-            if choice in ['y', 'yes', 'да']:
+            choice = (await _ainput("\nПродолжить обработку? (y/n): ")).strip().casefold()
+            if choice in _YES:
                 return True
-            elif choice in ['n', 'no', 'нет']:
+            elif choice in _NO:
                 return False
             else:
                 print("Введите 'y' или 'n'")
@@ -188,62 +250,84 @@ class CLIInterface:
         
         preview = await self.pipeline.get_deck_preview(deck_name, note_type_name)
         
-        print(f"\n=== ПРЕВЬЮ КОЛОДЫ ===")
-        print(f"Всего заметок: {preview['total_notes']}")
+        lines = [
+            f"\n=== ПРЕВЬЮ КОЛОДЫ ===",
+            f"Всего заметок: {preview['total_notes']}"
+        ]
         
         if preview['total_notes'] == 0:
-            print("Заметки не найдены")
+            _screen(*lines, "Заметки не найдены")
             return False
         
         # Показываем валидацию
         validation = preview['validation']
-        print(f"Валидных заметок: {validation['valid_notes']}")
-        print(f"Невалидных заметок: {validation['invalid_notes']}")
+        lines += [
+            f"Валидных заметок: {validation['valid_notes']}",
+            f"Невалидных заметок: {validation['invalid_notes']}"
+        ]
         
         if validation['invalid_notes'] > 0:
-            print(f"⚠️  Найдено {validation['error_count']} ошибок валидации")
+            _screen(*lines, f"⚠️  Найдено {validation['error_count']} ошибок валидации")
+            lines = []
             
-            show_errors = input("Показать детали ошибок? (y/n): ").strip().lower()
-            if show_errors in ['y', 'yes', 'да']:
+            show_errors = (await _ainput("Показать детали ошибок? (y/n): ")).strip().casefold()
+            if show_errors in _YES:
                 await self._show_validation_errors(deck_name, note_type_name)
         
+        if validation['valid_notes'] > 0:
+            lines.append(
+                f"Кеш LLM покроет {preview['llm_cache_hits']} из "
+                f"{validation['valid_notes']} валидных заметок"
+            )
+        
         # Показываем примеры заметок
         if preview['sample_notes']:
-            print(f"\nПример заметок (первые {len(preview['sample_notes'])}):")
-            for note in preview['sample_notes']:
-                print(f"  ID {note['note_id']}: {note['fields']}")
+            lines.append(f"\nПример заметок (первые {len(preview['sample_notes'])}):")
+            lines += [
+                f"  ID {note['note_id']}: {note['fields']}"
+                for note in preview['sample_notes']
+            ]
         
         # Подтверждение продолжения
         if validation['invalid_notes'] > 0:
             if PROCESSING_CONFIG.skip_invalid_notes:
-                print(f"\n📋 ИНФОРМАЦИЯ: {validation['invalid_notes']} невалидных заметок будут пропущены автоматически")
-                print(f"Будут обработаны только {validation['valid_notes']} валидных заметок")
+                lines += [
+                    f"\n📋 ИНФОРМАЦИЯ: {validation['invalid_notes']} невалидных заметок будут пропущены автоматически",
+                    f"Будут обработаны только {validation['valid_notes']} валидных заметок"
+                ]
             elif not PROCESSING_CONFIG.dry_run:
-                print(f"\n⚠️  ВНИМАНИЕ: {validation['invalid_notes']} заметок не будут обработаны из-за ошибок валидации")
+                _screen(
+                    *lines,
+                    f"\n⚠️  ВНИМАНИЕ: {validation['invalid_notes']} заметок не будут обработаны из-за ошибок валидации"
+                )
                 
                 while True:
-                    choice = input("Продолжить с валидными заметками? (y/n): ").strip().lower()
-                    if choice in ['y', 'yes', 'да']:
+                    choice = (await _ainput("Продолжить с валидными заметками? (y/n): ")).strip().casefold()
+                    if choice in _YES:
                         return True
-                    elif choice in ['n', 'no', 'нет']:
+                    elif choice in _NO:
                         return False
                     else:
                         print("Введите 'y' или 'n'")
         
+        if lines:
+            _screen(*lines)
         return True
     
     async def _show_validation_errors(self, deck_name: str, note_type_name: str):
         """Показать детальные ошибки валидации."""
-        # Получаем заметки и валидируем
         query = f'deck:"{deck_name}" note:"{note_type_name}"'
         note_ids = await self.anki_client.find_notes(query)
-        notes = await self.anki_client.get_notes_info(note_ids)
-        
-        validation_report = self.validator.validate_notes(notes, note_type_name)
         
-        if validation_report.errors:
-            print("\n=== ДЕТАЛИ ОШИБОК ВАЛИДАЦИИ ===")
-            print(self.validator.print_validation_report(validation_report))
+        # Печатаем ошибки по мере загрузки батчей notesInfo
+        header_printed = False
+        async for note_id, note_errors in self.validator.iter_validation_errors(
+            self.anki_client.iter_notes_info(note_ids), note_type_name
+        ):
+            if not header_printed:
+                print("\n=== ДЕТАЛИ ОШИБОК ВАЛИДАЦИИ ===")
+                header_printed = True
+            print(self.validator.format_note_errors(note_id, note_errors))
     
     async def _run_processing(self, deck_name: str, note_type_name: str):
         """Запуск основной обработки."""
@@ -254,14 +338,13 @@ class CLIInterface:
         
         result = await self.pipeline.process_deck(deck_name, note_type_name)
         
-        if result.success:
-            print("✅ Обработка завершена успешно!")
-            if result.error:  # Содержит статистику
-                print(f"📊 {result.error}")
-        else:
-            print("❌ Обработка завершена с ошибками")
-            if result.error:
-                print(f"📊 {result.error}")
+        lines = [
+            "✅ Обработка завершена успешно!" if result.success
+            else "❌ Обработка завершена с ошибками"
+        ]
+        if result.error:  # Содержит статистику
+            lines.append(f"📊 {result.error}")
+        _screen(*lines)
     
     def _handle_interrupt(self):
         """Обработка прерывания."""
@@ -284,7 +367,7 @@ def cli_entry_point():
         print("\nПрограмма прервана пользователем")
         sys.exit(0)
     except Exception as e:
-        logger.error(f"Необработанная ошибка: {e}")
+        logger.error("Необработанная ошибка: {}", e)
         print(f"Критическая ошибка: {e}")
         sys.exit(1)
 
@@ -1,16 +1,22 @@
 """Конфигурация промптов, типов заметок и параметров обработки."""
 
-from typing import Dict
+import functools
+import sys
+from types import MappingProxyType
+from typing import FrozenSet, Mapping, Tuple
 
 from .schemas import FieldMode, NoteTypeConfig, NoteTypeFieldConfig
 
-# Белый список тегов
-ALLOWED_TAGS = [
+# Белый список тегов (порядок важен для текста промпта)
+ALLOWED_TAGS: Tuple[str, ...] = (
     "A2","B1","B2","C1","C2",
     "noun","verb","adj","adv","prep","conj","intj",
     "business","everyday","academic","technical","emotional","phrasal","idiom","slang","collocation",
     "formal","informal","neutral","rude"
-]
+)
+# Для проверки тегов из ответа LLM
+ALLOWED_TAGS_SET: FrozenSet[str] = frozenset(ALLOWED_TAGS)
+_ALLOWED_TAGS_JOINED = ", ".join(ALLOWED_TAGS)
 
 STRICT_SYSTEM_PROMPT = (
     "Return ONLY valid JSON, no text outside JSON. No markdown. No comments.\n"
@@ -50,7 +56,7 @@ STRICT_SYSTEM_PROMPT = (
     "- hint: 1–2 Russian sentences, explain the exact sense used in `sentence`.\n"
     "- tags: 3–4 items total. Exactly ONE CEFR level (A2/B1/B2/C1/C2). "
     "Other tags ONLY from: "
-    f"{', '.join(ALLOWED_TAGS)}. "
+    f"{_ALLOWED_TAGS_JOINED}. "
     "Use 'everyday' ONLY for core daily vocabulary; use 'academic'/'technical' ONLY when clearly applicable. No duplicates.\n"
 )
 
@@ -142,22 +148,31 @@ ANTI_HALLUCINATION_RULES = (
 )
 
 
-# Системный промпт для OpenAI
-SYSTEM_PROMPT = (
-    STRICT_SYSTEM_PROMPT
-    + "\n\nField guides:\n"
-    + "\n".join(f"- {k}: {v}" for k, v in FIELD_PROMPTS.items())
-    + "\n\nAnti-hallucination:\n"
-    + ANTI_HALLUCINATION_RULES
-)
+# Системный промпт для OpenAI (собирается при первом обращении)
+@functools.cache
+def get_system_prompt() -> str:
+    """Собрать системный промпт для OpenAI."""
+    return (
+        STRICT_SYSTEM_PROMPT
+        + "\n\nField guides:\n"
+        + "\n".join(f"- {k}: {v}" for k, v in FIELD_PROMPTS.items())
+        + "\n\nAnti-hallucination:\n"
+        + ANTI_HALLUCINATION_RULES
+    )
+
+
+@functools.cache
+def get_system_prompt_bytes() -> bytes:
+    """Системный промпт в UTF-8 (один неизменный префикс для всех запросов)."""
+    return get_system_prompt().encode("utf-8")
 
 
 
 # Конфигурации типов заметок
-NOTE_TYPE_CONFIGS: Dict[str, NoteTypeConfig] = {
+_NOTE_TYPE_CONFIGS = {
     "ForkLapisForEnglsih": NoteTypeConfig(
         name="ForkLapisForEnglsih",
-        llm_prompt=SYSTEM_PROMPT,
+        llm_prompt_factory=get_system_prompt,
         fields={
             "Expression": NoteTypeFieldConfig(mode=FieldMode.INPUT),
             "Sentence": NoteTypeFieldConfig(mode=FieldMode.INPUT),
@@ -208,15 +223,20 @@ NOTE_TYPE_CONFIGS: Dict[str, NoteTypeConfig] = {
             "IsClickCard": NoteTypeFieldConfig(mode=FieldMode.SKIP),
             "IsSentenceCard": NoteTypeFieldConfig(mode=FieldMode.SKIP)
         },
-        input_fields=["Expression", "Sentence"],
-        generate_fields=[
+        input_fields=("Expression", "Sentence"),
+        generate_fields=(
             "MainDefinition", "MainDefinitionRU", "ExpressionAudio", 
             "IPA", "FreqSort", "Collocations", "Synonyms", "Antonyms", 
             "RelatedForms", "E.g.", "Hint"
-        ]
+        )
     )
 }
 
+# Неизменяемое представление: конфигурации общие для всех компонентов
+NOTE_TYPE_CONFIGS: Mapping[str, NoteTypeConfig] = MappingProxyType({
+    sys.intern(name): config for name, config in _NOTE_TYPE_CONFIGS.items()
+})
+
 # Параметры обработки
 DEFAULT_CONCURRENCY_LIMITS = {
     "openai_text": 10,
@@ -1,21 +1,182 @@
 """Модуль для работы с частотностью слов."""
 
-import json
+import bisect
+import math
+import os
+import pickle
+from array import array
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
 
+import orjson
 from loguru import logger
 from wordfreq import word_frequency, zipf_frequency
 
 from .schemas import FrequencyData
-from .settings import FREQ_DICT_PATH
+from .settings import CACHE_CONFIG, FREQ_DICT_PATH
+
+# Запись локального словаря: (слово, rank, frequency, zipf_score)
+FreqEntry = Tuple[str, Optional[int], float, Optional[float]]
+
+# Значения-заглушки для отсутствующих rank и zipf_score в массивах словаря
+NO_RANK = 0
+NO_ZIPF = math.nan
+
+# Снимок разобранного словаря в директории кеша; версия меняется вместе с форматом
+FREQ_SNAPSHOT_NAME = "freq_dict.pkl"
+SNAPSHOT_VERSION = 2
+
+# Ключ FreqSort: ранг фиксированной ширины с ведущими нулями
+FREQ_KEY_WIDTH = 6
+MAX_FREQUENCY_RANK = 10 ** FREQ_KEY_WIDTH - 1
+
+# Пустой результат для пустого слова и ошибок wordfreq: значения заведомо
+# корректны, поэтому валидация pydantic не нужна, а копия подставляет word
+_EMPTY_FD = FrequencyData.model_construct(word="", frequency=0.0, rank=None, zipf_score=0.0)
+
+
+def format_frequency_key(rank: int) -> str:
+    """Записать ранг строкой, сортирующейся так же, как число."""
+    return f"{max(1, min(rank, MAX_FREQUENCY_RANK)):0{FREQ_KEY_WIDTH}d}"
+
+
+def _sort_rank(rank: Optional[int], zipf_score: Optional[float], frequency: float) -> int:
+    """Ранг для FreqSort: rank, иначе псевдо-ранг из zipf_score, иначе из frequency."""
+    if rank:
+        return rank
+    # Реже слово - больше ранг
+    if zipf_score and zipf_score > 0:
+        return int(1_000_000 * 10 ** (-zipf_score))
+    if frequency and frequency > 0:
+        return int(1 / frequency)
+    return MAX_FREQUENCY_RANK
+
+
+def is_frequency_key(value: str) -> bool:
+    """Проверить, что значение FreqSort записано в текущем формате."""
+    return len(value) == FREQ_KEY_WIDTH and value.isdigit()
+
+
+# Категории частотности (от частых к редким) и границы rank/zipf между ними
+CATEGORIES = ("very_common", "common", "uncommon", "rare")
+_RANK_BOUNDS = (1000, 5000, 20000)
+_ZIPF_BOUNDS = (4.0, 5.5, 6.5)
+
+
+def _category_index(rank: Optional[int], zipf_score: Optional[float]) -> int:
+    """Индекс категории в CATEGORIES: сначала по rank, затем по zipf_score."""
+    if rank:
+        return bisect.bisect_left(_RANK_BOUNDS, rank)
+    if zipf_score and not math.isnan(zipf_score):
+        return len(_ZIPF_BOUNDS) - bisect.bisect_right(_ZIPF_BOUNDS, zipf_score)
+    return len(CATEGORIES) - 1
+
+
+def _detect_schema(data: Any) -> str:
+    """Определить формат словаря частот по его структуре."""
+    if isinstance(data, dict):
+        # Формат: {"word": {"frequency": ..., "rank": ...}, ...}
+        return "mapping"
+    
+    if isinstance(data, list):
+        if not data:
+            return "empty"
+        # Формат определяем по первой пригодной записи: отдельные битые
+        # записи пропускаются при чтении и не должны решать за весь словарь
+        first = next(
+            (item for item in data if isinstance(item, dict) and "word" in item),
+            None
+        )
+        if first is None:
+            raise ValueError("Записи словаря должны быть объектами с полем 'word'")
+        # Формат: [{"id": 1, "word": "THE"}, ...] или
+        # [{"word": "...", "frequency": ..., "rank": ...}, ...]
+        return "ranked" if "id" in first else "records"
+    
+    raise ValueError(f"Неподдерживаемый формат словаря: {type(data).__name__}")
+
+
+def _optional_int(value: Any) -> Optional[int]:
+    """Привести значение к int, сохранив None."""
+    return None if value is None else int(value)
+
+
+def _optional_float(value: Any) -> Optional[float]:
+    """Привести значение к float, сохранив None."""
+    return None if value is None else float(value)
+
+
+def _ranked_entry(item: Any) -> FreqEntry:
+    """Запись {"id": ..., "word": ...}: частота = 1 / rank."""
+    rank = int(item["id"])
+    if rank <= 0:
+        raise ValueError(f"некорректный id: {rank}")
+    return item["word"].lower(), rank, 1.0 / rank, None
+
+
+def _record_entry(item: Any) -> FreqEntry:
+    """Запись-объект с полями word/frequency/rank/zipf_score."""
+    return (
+        item["word"].lower(),
+        _optional_int(item.get("rank")),
+        _optional_float(item.get("frequency")) or 0.0,
+        _optional_float(item.get("zipf_score"))
+    )
+
+
+def _mapping_entry(pair: Tuple[Any, Any]) -> FreqEntry:
+    """Пара "слово -> данные о частоте" из словаря-отображения."""
+    word, freq_data = pair
+    return (
+        word.lower(),
+        _optional_int(freq_data.get("rank")),
+        _optional_float(freq_data.get("frequency")) or 0.0,
+        _optional_float(freq_data.get("zipf_score"))
+    )
+
+
+def _iter_valid(items: Iterable[Any], to_entry: Callable[[Any], FreqEntry]) -> Iterator[FreqEntry]:
+    """
+    Разобрать записи словаря, пропуская битые.
+    
+    Как и раньше, запись без нужных полей или с некорректными значениями
+    пропускается, а не обнуляет весь словарь; число пропущенных пишется в лог.
+    """
+    skipped = 0
+    for item in items:
+        try:
+            entry = to_entry(item)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            skipped += 1
+            continue
+        yield entry
+    
+    if skipped:
+        logger.warning(f"В словаре частот пропущено некорректных записей: {skipped}")
+
+
+_SCHEMA_READERS: Dict[str, Callable[[Any], Iterable[FreqEntry]]] = {
+    "ranked": lambda data: _iter_valid(data, _ranked_entry),
+    "records": lambda data: _iter_valid(data, _record_entry),
+    "mapping": lambda data: _iter_valid(data.items(), _mapping_entry),
+    "empty": lambda data: ()
+}
 
 
 class FrequencyCalculator:
     """Калькулятор частотности слов."""
     
     def __init__(self):
-        self.local_dict: dict = {}
+        # Локальный словарь хранится столбцами: слово -> индекс в массивах
+        self._idx: Dict[str, int] = {}
+        self._ranks = array("l")
+        self._freqs = array("f")
+        self._zipfs = array("f")
+        self._categories = array("B")  # индексы в CATEGORIES
+        self._sort_ranks = array("l")  # готовые ранги для FreqSort
+        # Результаты get_frequency_data по нормализованному слову: их запрашивают
+        # get_frequency_rank, is_common_word и get_frequency_category
+        self._lookup_cache: Dict[str, FrequencyData] = {}
         self.load_local_dictionary()
     
     def load_local_dictionary(self):
@@ -29,39 +190,105 @@ class FrequencyCalculator:
             logger.info(f"Словарь частот не найден: {FREQ_DICT_PATH}")
             return
         
+        # Сначала пробуем готовый бинарный снимок, собранный при прошлом запуске
+        if self._load_packed_snapshot(dict_path):
+            logger.info(f"Загружен локальный словарь частот из снимка: {len(self._idx)} слов")
+            return
+        
         try:
-            with open(dict_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            # Конвертируем в удобный формат: слово -> данные о частоте
-            if isinstance(data, list):
-                # Проверяем формат данных
-                if data and "id" in data[0] and "word" in data[0]:
-                    # Формат: [{"id": 1, "word": "THE"}, ...]
-                    self.local_dict = {
-                        item["word"].lower(): {"rank": item["id"], "frequency": 1.0 / item["id"]}
-                        for item in data 
-                        if "word" in item and "id" in item
-                    }
-                else:
-                    # Формат: [{"word": "...", "frequency": ..., "rank": ...}, ...]
-                    self.local_dict = {
-                        item["word"].lower(): item 
-                        for item in data 
-                        if "word" in item
-                    }
-            elif isinstance(data, dict):
-                # Формат: {"word": {"frequency": ..., "rank": ...}, ...}
-                self.local_dict = {
-                    word.lower(): freq_data 
-                    for word, freq_data in data.items()
-                }
+            data = orjson.loads(dict_path.read_bytes())
             
-            logger.info(f"Загружен локальный словарь частот: {len(self.local_dict)} слов")
+            # Формат определяем один раз по структуре, а не для каждой записи
+            reader = _SCHEMA_READERS[_detect_schema(data)]
+            self._pack_entries(reader(data))
+            
+            logger.info(f"Загружен локальный словарь частот: {len(self._idx)} слов")
             
         except Exception as e:
             logger.error(f"Ошибка загрузки словаря частот: {e}")
-            self.local_dict = {}
+            self._pack_entries(())
+            return
+        
+        self._save_packed_snapshot(dict_path)
+    
+    @staticmethod
+    def _source_stamp(dict_path: Path) -> Dict[str, Any]:
+        """Отпечаток исходного словаря: снимок действителен, пока он не изменился."""
+        stat = dict_path.stat()
+        return {
+            "version": SNAPSHOT_VERSION,
+            "source": str(dict_path.resolve()),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size
+        }
+    
+    def _load_packed_snapshot(self, dict_path: Path) -> bool:
+        """Загрузить разобранный словарь из снимка, если он соответствует исходнику."""
+        snapshot_path = Path(CACHE_CONFIG.dir) / FREQ_SNAPSHOT_NAME
+        if not snapshot_path.exists():
+            return False
+        
+        try:
+            snapshot = pickle.loads(snapshot_path.read_bytes())
+            if snapshot.get("stamp") != self._source_stamp(dict_path):
+                return False
+            
+            self._idx = snapshot["idx"]
+            self._ranks = snapshot["ranks"]
+            self._freqs = snapshot["freqs"]
+            self._zipfs = snapshot["zipfs"]
+            self._categories = snapshot["categories"]
+            self._sort_ranks = snapshot["sort_ranks"]
+            self._lookup_cache = {}
+            return True
+            
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать снимок словаря частот: {e}")
+            return False
+    
+    def _save_packed_snapshot(self, dict_path: Path):
+        """Сохранить разобранный словарь, чтобы следующий запуск не разбирал JSON."""
+        snapshot_path = Path(CACHE_CONFIG.dir) / FREQ_SNAPSHOT_NAME
+        temp_path = snapshot_path.with_suffix(".tmp")
+        
+        try:
+            temp_path.write_bytes(pickle.dumps({
+                "stamp": self._source_stamp(dict_path),
+                "idx": self._idx,
+                "ranks": self._ranks,
+                "freqs": self._freqs,
+                "zipfs": self._zipfs,
+                "categories": self._categories,
+                "sort_ranks": self._sort_ranks
+            }, protocol=pickle.HIGHEST_PROTOCOL))
+            os.replace(temp_path, snapshot_path)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить снимок словаря частот: {e}")
+    
+    def _pack_entries(self, entries: Iterable[FreqEntry]):
+        """Разложить записи словаря по параллельным массивам."""
+        idx: Dict[str, int] = {}
+        ranks, freqs, zipfs = array("l"), array("f"), array("f")
+        
+        for word, rank, frequency, zipf_score in entries:
+            rank = NO_RANK if rank is None else int(rank)
+            zipf_score = NO_ZIPF if zipf_score is None else float(zipf_score)
+            
+            i = idx.get(word)
+            if i is None:
+                idx[word] = len(ranks)
+                ranks.append(rank)
+                freqs.append(frequency)
+                zipfs.append(zipf_score)
+            else:
+                # Повторное слово перезаписывает предыдущее, как в dict
+                ranks[i], freqs[i], zipfs[i] = rank, frequency, zipf_score
+        
+        self._idx, self._ranks, self._freqs, self._zipfs = idx, ranks, freqs, zipfs
+        self._categories = array("B", map(_category_index, ranks, zipfs))
+        # NaN zipf_score (нет значения) сравнение "> 0" не проходит
+        self._sort_ranks = array("l", map(_sort_rank, ranks, zipfs, freqs))
+        self._lookup_cache = {}
     
     def get_frequency_data(self, word: str, lemma: str = None) -> FrequencyData:
         """
@@ -78,38 +305,48 @@ class FrequencyCalculator:
         search_word = (lemma or word).lower().strip()
         
         if not search_word:
-            return FrequencyData(
-                word=word,
-                frequency=0.0,
-                rank=None,
-                zipf_score=0.0
-            )
+            return _EMPTY_FD.model_copy(update={"word": word})
         
-        # Сначала ищем в локальном словаре
-        local_data = self._get_local_frequency(search_word)
-        if local_data:
-            return local_data
+        cached = self._lookup_cache.get(search_word)
+        if cached is not None:
+            return cached
         
-        # Если не найден локально, используем wordfreq
-        return self._get_wordfreq_data(search_word)
+        # Сначала ищем в локальном словаре, если не найден - используем wordfreq
+        freq_data = self._get_local_frequency(search_word) or self._get_wordfreq_data(search_word)
+        self._lookup_cache[search_word] = freq_data
+        return freq_data
+    
+    def prewarm(self, words: Iterable[str]) -> int:
+        """
+        Заранее посчитать частотность для набора слов (например, всей колоды).
+        
+        Returns:
+            Количество уникальных слов
+        """
+        unique_words = {word.lower().strip() for word in words}
+        unique_words.discard("")
+        
+        for word in unique_words:
+            self.get_frequency_data(word)
+        
+        return len(unique_words)
     
     def _get_local_frequency(self, word: str) -> Optional[FrequencyData]:
         """Получить частотность из локального словаря."""
-        if word not in self.local_dict:
+        i = self._idx.get(word)
+        if i is None:
             return None
         
-        data = self.local_dict[word]
+        rank = self._ranks[i]
+        zipf_score = self._zipfs[i]
         
-        try:
-            return FrequencyData(
-                word=word,
-                frequency=float(data.get("frequency", 0)),
-                rank=data.get("rank"),
-                zipf_score=data.get("zipf_score")
-            )
-        except (ValueError, TypeError) as e:
-            logger.warning(f"Некорректные данные в словаре для '{word}': {e}")
-            return None
+        # Значения уже приведены к int/float при упаковке массивов, валидация не нужна
+        return FrequencyData.model_construct(
+            word=word,
+            frequency=self._freqs[i],
+            rank=None if rank == NO_RANK else rank,
+            zipf_score=None if math.isnan(zipf_score) else zipf_score
+        )
     
     def _get_wordfreq_data(self, word: str) -> FrequencyData:
         """Получить частотность через библиотеку wordfreq."""
@@ -120,9 +357,10 @@ class FrequencyCalculator:
             # Zipf score (логарифмическая шкала, обычно 0-8)
             zipf_score = zipf_frequency(word, 'en')
             
-            logger.debug(f"wordfreq для '{word}': freq={frequency}, zipf={zipf_score}")
+            logger.debug("wordfreq для '{}': freq={}, zipf={}", word, frequency, zipf_score)
             
-            return FrequencyData(
+            # wordfreq всегда возвращает float
+            return FrequencyData.model_construct(
                 word=word,
                 frequency=frequency,
                 rank=None,  # wordfreq не предоставляет rank
@@ -131,40 +369,27 @@ class FrequencyCalculator:
             
         except Exception as e:
             logger.warning(f"Ошибка получения частотности для '{word}': {e}")
-            return FrequencyData(
-                word=word,
-                frequency=0.0,
-                rank=None,
-                zipf_score=0.0
-            )
+            return _EMPTY_FD.model_copy(update={"word": word})
     
     def get_frequency_rank(self, word: str, lemma: str = None) -> str:
         """
         Получить ранг частотности как строку для поля FreqSort.
         
+        Ранг записывается фиксированной ширины с ведущими нулями, чтобы
+        сортировка Anki по строке совпадала с сортировкой по числу.
+        
         Returns:
-            Строка с рангом или пустая строка
+            Строка из FREQ_KEY_WIDTH цифр
         """
-        freq_data = self.get_frequency_data(word, lemma)
+        # Для слов локального словаря ранг посчитан при загрузке
+        i = self._idx.get((lemma or word).lower().strip())
+        if i is not None:
+            return format_frequency_key(self._sort_ranks[i])
         
-        # Приоритет: rank из локального словаря
-        if freq_data.rank is not None:
-            return str(freq_data.rank)
-        
-        # Если нет rank, используем zipf_score
-        if freq_data.zipf_score and freq_data.zipf_score > 0:
-            # Записываем zipf score с приставкой
-            zipf_value = round(freq_data.zipf_score, 2)
-            logger.debug(f"Zipf для '{word}': {zipf_value}")
-            return f"zipf {zipf_value}"
-        
-        # Если есть только frequency
-        if freq_data.frequency and freq_data.frequency > 0:
-            estimated_rank = int(1 / freq_data.frequency)
-            return str(max(1, min(estimated_rank, 999999)))
-        
-        # Если ничего нет, возвращаем высокий ранг
-        return "999999"
+        freq_data = self.get_frequency_data(word, lemma)
+        return format_frequency_key(
+            _sort_rank(freq_data.rank, freq_data.zipf_score, freq_data.frequency)
+        )
     
     def is_common_word(self, word: str, lemma: str = None, threshold: float = 5.0) -> bool:
         """
@@ -195,47 +420,10 @@ class FrequencyCalculator:
         Returns:
             Одна из категорий: "very_common", "common", "uncommon", "rare"
         """
-        freq_data = self.get_frequency_data(word, lemma)
+        # Для слов локального словаря категория посчитана при загрузке
+        i = self._idx.get((lemma or word).lower().strip())
+        if i is not None:
+            return CATEGORIES[self._categories[i]]
         
-        if freq_data.rank:
-            if freq_data.rank <= 1000:
-                return "very_common"
-            elif freq_data.rank <= 5000:
-                return "common"
-            elif freq_data.rank <= 20000:
-                return "uncommon"
-            else:
-                return "rare"
-        
-        if freq_data.zipf_score:
-            if freq_data.zipf_score >= 6.5:
-                return "very_common"
-            elif freq_data.zipf_score >= 5.5:
-                return "common"
-            elif freq_data.zipf_score >= 4.0:
-                return "uncommon"
-            else:
-                return "rare"
-        
-        return "rare"
-    
-    def save_frequency_cache(self, cache_data: dict, cache_path: Path):
-        """Сохранить кеш частотности в файл."""
-        try:
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, ensure_ascii=False, indent=2)
-            logger.debug(f"Кеш частотности сохранен: {len(cache_data)} записей")
-        except Exception as e:
-            logger.error(f"Ошибка сохранения кеша частотности: {e}")
-    
-    def load_frequency_cache(self, cache_path: Path) -> dict:
-        """Загрузить кеш частотности из файла."""
-        if not cache_path.exists():
-            return {}
-        
-        try:
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Ошибка загрузки кеша частотности: {e}")
-            return {}
+        freq_data = self.get_frequency_data(word, lemma)
+        return CATEGORIES[_category_index(freq_data.rank, freq_data.zipf_score)]
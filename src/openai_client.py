@@ -1,8 +1,12 @@
 """Клиент для работы с OpenAI API - генерация словарных данных."""
 
+import asyncio
+import functools
 import json
-from typing import Dict, Optional
+from typing import List, Optional, Tuple
 
+import orjson
+import tiktoken
 from loguru import logger
 from openai import AsyncOpenAI
 from pydantic import ValidationError
@@ -11,6 +15,44 @@ from .schemas import LLMWordData
 from .settings import OPENAI_CONFIG
 from .utils import retry_with_backoff
 
+# Пользовательский промпт для одного слова - тот же JSON, что выдал бы
+# json.dumps({"task": ..., "word": ..., "sentence": ..., "requirements": [...]})
+_USER_PROMPT_REQUIREMENTS = [
+    "Ответь только валидным JSON",
+    "Все поля обязательны",
+    "Используй указанное значение слова из sentence",
+    "Сохраняй HTML разметку только где указано",
+    "Не изобретай коллокации - используй проверенные"
+]
+_USER_PROMPT_PREFIX = '{"task": "generateWordData", "word": '
+_USER_PROMPT_MIDDLE = ', "sentence": '
+_USER_PROMPT_SUFFIX = (
+    ', "requirements": '
+    + json.dumps(_USER_PROMPT_REQUIREMENTS, ensure_ascii=False)
+    + '}'
+)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_encoding(model: str) -> Optional["tiktoken.Encoding"]:
+    """Получить BPE кодировку модели (создание дорогое, поэтому кешируется)."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Модель неизвестна tiktoken - используем кодировку современных моделей
+        pass
+    except Exception as e:
+        # Файл BPE не скачался или не читается (например, без сети). Результат
+        # кешируется, поэтому предупреждение пишется один раз на модель
+        logger.warning(f"Не удалось загрузить кодировку tiktoken для {model}: {e}")
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # Файл кодировки скачивается при первом использовании и может быть недоступен
+        logger.warning(f"Не удалось загрузить кодировку tiktoken: {e}")
+        return None
+
 
 class OpenAIClientError(Exception):
     """Ошибка OpenAI клиента."""
@@ -29,14 +71,33 @@ class OpenAITextClient:
         )
         self.model = OPENAI_CONFIG.text_model
     
+    async def aclose(self):
+        """Закрыть HTTP соединения с API."""
+        await self.client.close()
+    
     def _build_user_prompt(self, word: str, sentence: str) -> str:
         """Построить пользовательский промпт."""
+        # Статичные части JSON собраны заранее, сериализуются только word и sentence
+        return (
+            _USER_PROMPT_PREFIX
+            + json.dumps(word, ensure_ascii=False)
+            + _USER_PROMPT_MIDDLE
+            + json.dumps(sentence, ensure_ascii=False)
+            + _USER_PROMPT_SUFFIX
+        )
+    
+    def _build_batch_user_prompt(self, items: List[Tuple[str, str]]) -> str:
+        """Построить пользовательский промпт для нескольких слов."""
         return json.dumps({
-            "task": "generateWordData",
-            "word": word,
-            "sentence": sentence,
+            "task": "generateWordDataBatch",
+            "items": [
+                {"index": index, "word": word, "sentence": sentence}
+                for index, (word, sentence) in enumerate(items)
+            ],
             "requirements": [
-                "Ответь только валидным JSON",
+                "Ответь только валидным JSON вида {\"results\": [...]}",
+                "results[i] - объект по схеме для items[i], порядок и количество как в items",
+                "Каждый объект results содержит поля index и word, скопированные из своего элемента items",
                 "Все поля обязательны",
                 "Используй указанное значение слова из sentence",
                 "Сохраняй HTML разметку только где указано",
@@ -71,26 +132,135 @@ class OpenAITextClient:
                     logger.error(f"Пустой контент в ответе для '{word}'")
                     return None
                 
-                json_data = json.loads(content)
+                json_data = orjson.loads(content)
                 
                 # Валидируем через Pydantic
                 word_data = LLMWordData(**json_data)
-                logger.debug(f"Успешно сгенерированы данные для '{word}'")
+                logger.debug("Успешно сгенерированы данные для '{}'", word)
                 return word_data
                 
-            except json.JSONDecodeError as e:
+            except orjson.JSONDecodeError as e:
                 logger.error(f"Ошибка парсинга JSON для '{word}': {e}")
-                logger.debug(f"Содержимое ответа: {content}")
+                logger.debug("Содержимое ответа: {}", content)
                 return None
             except ValidationError as e:
                 logger.error(f"Ошибка валидации данных для '{word}': {e}")
-                logger.debug(f"Данные: {json_data}")
+                logger.debug("Данные: {}", json_data)
                 return None
                 
         except Exception as e:
             logger.error(f"Ошибка генерации данных для '{word}': {e}")
             return None
     
+    async def generate_word_data_batch(
+        self,
+        items: List[Tuple[str, str]],
+        system_prompt: str
+    ) -> List[Optional[LLMWordData]]:
+        """
+        Сгенерировать словарные данные для нескольких слов одним запросом.
+        
+        Args:
+            items: Пары (слово, предложение)
+            system_prompt: Системный промпт
+            
+        Returns:
+            Данные в порядке items, None для слов без валидного ответа
+        """
+        if len(items) == 1:
+            word, sentence = items[0]
+            return [await self.generate_word_data(word, sentence, system_prompt)]
+        
+        results = await self._request_word_data_batch(items, system_prompt)
+        
+        # Строки, которые не удалось однозначно сопоставить со словом, не
+        # сохраняются: такие слова запрашиваются по одному
+        failed = [index for index, data in enumerate(results) if data is None]
+        if failed:
+            logger.warning(
+                f"Повторный запрос по одному для {len(failed)} из {len(items)} слов: "
+                + ", ".join(items[index][0] for index in failed)
+            )
+            retried = await asyncio.gather(*(
+                self.generate_word_data(items[index][0], items[index][1], system_prompt)
+                for index in failed
+            ))
+            for index, data in zip(failed, retried):
+                results[index] = data
+        
+        return results
+    
+    async def _request_word_data_batch(
+        self,
+        items: List[Tuple[str, str]],
+        system_prompt: str
+    ) -> List[Optional[LLMWordData]]:
+        """
+        Один запрос на несколько слов.
+        
+        Строка ответа принимается, только если ее index и word совпадают с
+        элементом items; при неверном количестве строк отбрасываются все.
+        """
+        results: List[Optional[LLMWordData]] = [None] * len(items)
+        words = ", ".join(word for word, _ in items)
+        
+        try:
+            response = await retry_with_backoff(
+                self._make_completion_request,
+                system_prompt=system_prompt,
+                user_prompt=self._build_batch_user_prompt(items)
+            )
+            
+            content = response.choices[0].message.content if response else None
+            if not content:
+                logger.error(f"Пустой ответ для слов: {words}")
+                return results
+            
+            try:
+                rows = orjson.loads(content).get("results")
+            except (orjson.JSONDecodeError, AttributeError) as e:
+                logger.error(f"Ошибка парсинга JSON для слов {words}: {e}")
+                logger.debug("Содержимое ответа: {}", content)
+                return results
+            
+            if not isinstance(rows, list):
+                logger.error(f"В ответе нет списка results для слов: {words}")
+                return results
+            if len(rows) != len(items):
+                # Модель потеряла или склеила строки - позициям доверять нельзя
+                logger.warning(f"Получено {len(rows)} результатов вместо {len(items)} для слов: {words}")
+                return results
+            
+            for row in rows:
+                if not isinstance(row, dict):
+                    logger.error(f"Строка ответа не объект: {row}")
+                    continue
+                row = dict(row)
+                index = row.pop("index", None)
+                echoed_word = row.pop("word", None)
+                if (
+                    not isinstance(index, int)
+                    or isinstance(index, bool)
+                    or not 0 <= index < len(items)
+                    or results[index] is not None
+                    or not isinstance(echoed_word, str)
+                    or echoed_word.strip().lower() != items[index][0].strip().lower()
+                ):
+                    logger.error(f"Строка ответа не сопоставлена со словом: index={index}, word={echoed_word}")
+                    continue
+                
+                try:
+                    results[index] = LLMWordData(**row)
+                except (TypeError, ValidationError) as e:
+                    logger.error(f"Ошибка валидации данных для '{items[index][0]}': {e}")
+                    logger.debug("Данные: {}", row)
+            
+            return results
+            
+        except Exception as e:
+            logger.error(f"Ошибка генерации данных для слов {words}: {e}")
+            return results
+    
     async def _make_completion_request(
         self, 
         system_prompt: str, 
@@ -143,32 +313,9 @@ class OpenAITextClient:
             return []
     
     def estimate_tokens(self, text: str) -> int:
-        """Оценка количества токенов в тексте (приблизительно)."""
-        # Грубая оценка: ~4 символа на токен для английского
-        return len(text) // 4
-    
-    async def batch_generate_word_data(
-        self,
-        word_sentence_pairs: list[tuple[str, str]],
-        system_prompt: str,
-        concurrency_limit: int = 10
-    ) -> Dict[str, Optional[LLMWordData]]:
-        """Батчевая генерация данных для списка слов."""
-        import asyncio
-        
-        semaphore = asyncio.Semaphore(concurrency_limit)
-        results = {}
-        
-        async def process_word(word: str, sentence: str):
-            async with semaphore:
-                data = await self.generate_word_data(word, sentence, system_prompt)
-                results[word.lower()] = data
-                return word, data
-        
-        tasks = [
-            process_word(word, sentence) 
-            for word, sentence in word_sentence_pairs
-        ]
-        
-        await asyncio.gather(*tasks, return_exceptions=True)
-        return results
+        """Количество токенов в тексте по BPE словарю модели."""
+        encoding = _get_encoding(self.model)
+        if encoding is None:
+            # Грубая оценка: ~4 символа на токен для английского
+            return len(text) // 4
+        return len(encoding.encode(text, disallowed_special=()))
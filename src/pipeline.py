@@ -1,67 +1,146 @@
 """Основной пайплайн обработки заметок Anki."""
 
 import asyncio
-from typing import Dict, List, Optional, Tuple
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
 from loguru import logger
 from tqdm.asyncio import tqdm
 
 from .anki_client import AnkiClient
 from .cache import CacheManager
-from .config import DEFAULT_CONCURRENCY_LIMITS, NOTE_TYPE_CONFIGS, ALLOWED_TAGS
-from .freq import FrequencyCalculator
+from .config import (
+    ALLOWED_TAGS_SET,
+    DEFAULT_CONCURRENCY_LIMITS,
+    NOTE_TYPE_CONFIGS,
+    get_system_prompt,
+    get_system_prompt_bytes
+)
+from .freq import FrequencyCalculator, is_frequency_key
 from .openai_client import OpenAITextClient
-from .schemas import AnkiNote, FieldMode, LLMWordData, ProcessingResult
+from .schemas import AnkiNote, LLMWordData, ProcessingResult
 from .settings import PROCESSING_CONFIG
-from .utils import AsyncSemaphorePool, ProgressTracker, batch_items
+from .utils import (
+    AsyncSemaphorePool,
+    generate_cache_key,
+    generate_llm_cache_key,
+    prompt_version
+)
 from .validators import NoteValidator
 from .voice_client import VoiceClient
 
+# Сколько ждать остальные заметки перед отправкой неполного батча в LLM (сек)
+LLM_BATCH_LINGER = 0.05
+
+# Батч отправляется раньше llm_rows_per_call, если входные слова и предложения
+# набрали столько токенов: длинные предложения не раздувают один запрос
+LLM_BATCH_MAX_INPUT_TOKENS = 2000
+
+# Как часто дописывать новые записи кешей на диск во время обработки (сек)
+CACHE_FLUSH_INTERVAL = 30.0
+
+# Максимальная длина значения поля в превью колоды
+PREVIEW_FIELD_LENGTH = 60
+
 
 class ProcessingPipeline:
     """Основной пайплайн обработки заметок."""
     
-    def __init__(self):
-        self.anki_client = AnkiClient()
+    def __init__(self, anki_client: Optional[AnkiClient] = None):
+        # Клиент Anki можно передать снаружи, чтобы делить одно соединение
+        self.anki_client = anki_client or AnkiClient()
         self.openai_client = OpenAITextClient()
-        self.voice_client = VoiceClient()
+        self.voice_client = VoiceClient(self.openai_client.client)
         self.freq_calculator = FrequencyCalculator()
         self.cache_manager = CacheManager()
         self.validator = NoteValidator()
         
         # Пул семафоров для контроля параллелизма
         self.semaphore_pool = AsyncSemaphorePool(DEFAULT_CONCURRENCY_LIMITS)
+        self._openai_semaphore = self.semaphore_pool.get_semaphore("openai_text")
+        self._tts_semaphore = self.semaphore_pool.get_semaphore("openai_tts")
         
         self.dry_run = PROCESSING_CONFIG.dry_run
-        self.force_regenerate = PROCESSING_CONFIG.force_regenerate
+        # frozenset: проверки "all"/"llm" in ... выполняются для каждой заметки
+        self.force_regenerate = frozenset(PROCESSING_CONFIG.force_regenerate)
         self.skip_audio = PROCESSING_CONFIG.skip_audio
         self.skip_frequency = PROCESSING_CONFIG.skip_frequency
         self.skip_invalid_notes = PROCESSING_CONFIG.skip_invalid_notes
+        self.llm_rows_per_call = PROCESSING_CONFIG.llm_rows_per_call
+        self.note_workers = PROCESSING_CONFIG.note_workers
+        
+        # Заметки, ожидающие отправки в LLM одним запросом
+        self._llm_queue: List[Tuple[str, str, asyncio.Future]] = []
+        self._llm_queue_tokens = 0
+        self._llm_flush_handle: Optional[asyncio.TimerHandle] = None
+        self._llm_tasks: Set[asyncio.Task] = set()
+        # Фоновая запись кеша заметок после загрузки колоды
+        self._notes_save_task: Optional[asyncio.Task] = None
+        # Идущие генерации по ключу кеша LLM: одинаковые заметки делят один запрос
+        self._llm_inflight: Dict[str, asyncio.Future] = {}
+        # Фоновый подсчет частотности колоды, идет параллельно с запросами к LLM
+        self._freq_prewarm: Optional[asyncio.Task] = None
     
     async def initialize(self):
         """Инициализация пайплайна."""
         logger.info("Инициализация пайплайна...")
         
-        # Проверяем подключения
-        anki_ok = await self.anki_client.check_connection()
-        if not anki_ok:
-            raise RuntimeError("Не удалось подключиться к Anki")
-        
-        openai_ok = await self.openai_client.validate_connection()
-        if not openai_ok:
-            raise RuntimeError("Не удалось подключиться к OpenAI")
+        # Кеши читаются с диска, пока проверяются подключения
+        cache_load = asyncio.create_task(self.cache_manager.load_all_caches())
         
-        if not self.skip_audio:
-            tts_ok = await self.voice_client.validate_connection()
-            if not tts_ok:
-                logger.warning("TTS недоступен, аудио будет пропущено")
-                self.skip_audio = True
+        try:
+            # Проверяем подключения
+            anki_ok = await self.anki_client.check_connection()
+            if not anki_ok:
+                raise RuntimeError("Не удалось подключиться к Anki")
+            
+            openai_ok = await self.openai_client.validate_connection()
+            if not openai_ok:
+                raise RuntimeError("Не удалось подключиться к OpenAI")
+            
+            if not self.skip_audio:
+                tts_ok = await self.voice_client.validate_connection()
+                if not tts_ok:
+                    logger.warning("TTS недоступен, аудио будет пропущено")
+                    self.skip_audio = True
+        except BaseException:
+            cache_load.cancel()
+            await asyncio.gather(cache_load, return_exceptions=True)
+            raise
         
         # Загружаем кеши
-        await self.cache_manager.load_all_caches()
+        await cache_load
+        
+        # Кодировка tiktoken для бюджета батча может скачиваться при первом
+        # использовании - загружаем ее в потоке, а не в цикле событий
+        if self.llm_rows_per_call > 1:
+            await asyncio.to_thread(self.openai_client.estimate_tokens, "")
+        
+        # Промпт идет первым сообщением и не меняется между запросами,
+        # поэтому провайдер может кешировать его как общий префикс
+        prompt_bytes = get_system_prompt_bytes()
+        logger.info(
+            f"Системный промпт: {len(prompt_bytes)} байт, "
+            f"версия {prompt_version(get_system_prompt())}"
+        )
         
         logger.info("Пайплайн инициализирован")
     
+    async def aclose(self):
+        """Отменить незавершенные запросы к LLM и закрыть соединения клиентов."""
+        if self._llm_flush_handle is not None:
+            self._llm_flush_handle.cancel()
+            self._llm_flush_handle = None
+        for task in self._llm_tasks:
+            task.cancel()
+        if self._llm_tasks:
+            await asyncio.gather(*self._llm_tasks, return_exceptions=True)
+        await self._wait_notes_cache_saved()
+        # Аудио дописывается до закрытия общего с TTS клиента OpenAI
+        await self.voice_client.aclose()
+        await self.openai_client.aclose()
+        await self.anki_client.aclose()
+    
     async def process_deck(
         self, 
         deck_name: str, 
@@ -89,13 +168,13 @@ class ProcessingPipeline:
                     error="Не найдено заметок для обработки"
                 )
             
-            # 2. Валидируем заметки
-            validation_ready, validation_message = self.validator.check_processing_readiness(
+            # 2-3. Валидируем заметки и отбираем валидные за один проход
+            validation_report, valid_notes = self.validator.validate_and_filter(
                 notes, note_type_name
             )
-            
-            # 3. Фильтруем валидные заметки
-            valid_notes = self.validator.filter_valid_notes(notes, note_type_name)
+            validation_ready, validation_message = self.validator.readiness_from_report(
+                validation_report
+            )
             invalid_count = len(notes) - len(valid_notes)
             
             if invalid_count > 0:
@@ -127,8 +206,18 @@ class ProcessingPipeline:
                     error=f"Dry run: готовы {len(valid_notes)} заметок"
                 )
             
-            # 4. Обрабатываем заметки
-            results = await self._process_notes_batch(valid_notes, note_type_name)
+            # 4. Обрабатываем заметки. Частотность считается в потоке, пока
+            # заметки ждут ответа LLM, а не перед их запуском
+            if not self.skip_frequency:
+                self._freq_prewarm = asyncio.create_task(
+                    self._prewarm_frequencies(valid_notes, note_type_name)
+                )
+            try:
+                results = await self._process_notes_batch(valid_notes, note_type_name)
+            finally:
+                if self._freq_prewarm is not None:
+                    await asyncio.gather(self._freq_prewarm, return_exceptions=True)
+                    self._freq_prewarm = None
             
             # 5. Сохраняем кеши
             await self._save_all_caches()
@@ -185,11 +274,19 @@ class ProcessingPipeline:
         # Получаем информацию о заметках
         notes = await self.anki_client.get_notes_info(note_ids)
         
-        # Сохраняем в кеш
-        await self.cache_manager.save_notes_cache(notes)
+        # Сохраняем в кеш в фоне: заметки уже в памяти, ждать записи на диск не нужно.
+        # Предыдущая запись должна завершиться - обе пишут в один временный файл
+        await self._wait_notes_cache_saved()
+        self._notes_save_task = asyncio.create_task(self.cache_manager.save_notes_cache(notes))
         
         return notes
     
+    async def _wait_notes_cache_saved(self):
+        """Дождаться фоновой записи кеша заметок, если она идет."""
+        if self._notes_save_task is not None:
+            await asyncio.gather(self._notes_save_task, return_exceptions=True)
+            self._notes_save_task = None
+    
     async def _process_notes_batch(
         self, 
         notes: List[AnkiNote], 
@@ -198,76 +295,113 @@ class ProcessingPipeline:
         """Обработать батч заметок."""
         config = NOTE_TYPE_CONFIGS[note_type_name]
         
-        # Трекер прогресса
-        progress = ProgressTracker(len(notes), "Обработка заметок")
-        
         # Результаты обработки
         results = []
+        start_time = time.monotonic()
         
-        # Группируем заметки для параллельной обработки
-        tasks = []
+        # Уже обработанные заметки и заметки без входных данных отмечаем сразу,
+        # в очередь воркеров попадают только требующие обработки
+        queue: asyncio.Queue = asyncio.Queue()
         for note in notes:
-            task = self._process_single_note(note, config, progress)
-            tasks.append(task)
-        
-        # Выполняем с прогресс-баром
-        with tqdm(total=len(notes), desc="Обработка заметок") as pbar:
-            for coro in asyncio.as_completed(tasks):
-                result = await coro
+            input_data = self._extract_input_data(note, config)
+            skipped = self._check_note_skip(note, input_data)
+            if skipped is None:
+                queue.put_nowait((note, input_data))
+            else:
+                results.append(skipped)
+        
+        if results:
+            logger.info(f"Пропущено без обработки: {len(results)} заметок")
+        
+        # Фиксированный пул воркеров вместо задачи на каждую заметку
+        async def worker():
+            while True:
+                try:
+                    note, input_data = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                result = await self._process_single_note(note, config, input_data)
                 results.append(result)
+                # Прогресс-бар - единственный счетчик по ходу обработки,
+                # итог пишется в журнал один раз в конце
                 pbar.update(1)
         
-        progress.finish()
+        # Новые ответы LLM сохраняются по ходу обработки, а не только в конце,
+        # чтобы сбой посреди колоды не стоил повторных запросов
+        flusher = asyncio.create_task(self._flush_caches_periodically())
+        
+        # Выполняем с прогресс-баром. TaskGroup гарантирует, что при отмене
+        # (Ctrl+C) все воркеры будут отменены, а не продолжат писать в Anki
+        try:
+            with tqdm(
+                total=len(notes),
+                initial=len(results),
+                desc="Обработка заметок",
+                mininterval=0.5,
+                miniters=max(1, len(notes) // 200)
+            ) as pbar:
+                async with asyncio.TaskGroup() as tg:
+                    for _ in range(min(self.note_workers, queue.qsize())):
+                        tg.create_task(worker())
+        finally:
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+        
+        errors = sum(1 for result in results if not result.success)
+        logger.info(
+            f"Обработка заметок завершена: {pbar.n}/{len(notes)} "
+            f"за {time.monotonic() - start_time:.1f}сек. Ошибок: {errors}"
+        )
         return results
     
     async def _process_single_note(
         self, 
         note: AnkiNote, 
         config, 
-        progress: ProgressTracker
+        input_data: Optional[Dict[str, str]] = None
     ) -> ProcessingResult:
         """Обработать одну заметку."""
+        # Результаты собираются из внутренних значений - валидация pydantic не нужна
         try:
-            # Извлекаем входные данные
-            input_data = self._extract_input_data(note, config)
-            if not input_data:
-                progress.update(False)
-                return ProcessingResult(
-                    note_id=note.note_id,
-                    success=False,
-                    error="Отсутствуют входные данные"
-                )
+            # Извлекаем входные данные, если они не переданы готовыми
+            if input_data is None:
+                input_data = self._extract_input_data(note, config)
             
-            # Проверяем кеш
-            if self._is_note_already_processed(note, input_data):
-                progress.update(True)
-                return ProcessingResult(
-                    note_id=note.note_id,
-                    success=True,
-                    error="Уже обработано (из кеша)"
+            # Заметки без входных данных и уже обработанные пропускаем
+            skipped = self._check_note_skip(note, input_data)
+            if skipped is not None:
+                return skipped
+            
+            # Аудио зависит только от INPUT поля, поэтому TTS идет параллельно с LLM
+            audio_task = None
+            if not self.skip_audio and "ExpressionAudio" in config.fields:
+                audio_task = asyncio.create_task(
+                    self._generate_audio(input_data["word"], note.note_id)
                 )
             
             # Генерируем данные через OpenAI
-            llm_data = await self._generate_llm_data(
-                input_data["word"], 
-                input_data["sentence"], 
-                config.llm_prompt
-            )
+            try:
+                llm_data = await self._generate_llm_data(
+                    input_data["word"], 
+                    input_data["sentence"], 
+                    config.llm_prompt
+                )
+            except BaseException:
+                if audio_task is not None:
+                    audio_task.cancel()
+                raise
             
             if not llm_data:
-                progress.update(False)
-                return ProcessingResult(
+                if audio_task is not None:
+                    audio_task.cancel()
+                return ProcessingResult.model_construct(
                     note_id=note.note_id,
                     success=False,
                     error="Ошибка генерации LLM данных"
                 )
             
-            # Генерируем аудио
-            audio_filename = None
-            if not self.skip_audio and "ExpressionAudio" in config.fields:
-                audio_filename = await self._generate_audio(
-                    input_data["word"], note.note_id
-                )
+            # Дожидаемся аудио
+            audio_filename = await audio_task if audio_task is not None else None
             
             # Получаем частотность
             freq_rank = ""
@@ -281,31 +415,28 @@ class ProcessingPipeline:
                 config, llm_data, audio_filename, freq_rank
             )
             
-            # Обновляем заметку в Anki
-            update_success = await self.anki_client.update_note_fields(
-                note.note_id, field_updates
+            # Теги из ответа LLM (с фильтрацией по whitelist)
+            filtered_tags = None
+            if hasattr(llm_data, 'tags') and llm_data.tags:
+                filtered_tags = [tag for tag in llm_data.tags if tag in ALLOWED_TAGS_SET]
+            
+            # Обновляем поля и теги заметки в Anki одним запросом
+            update_success = await self.anki_client.update_note(
+                note.note_id, field_updates, filtered_tags
             )
             
             if update_success:
-                # Обновляем теги если есть (с фильтрацией по whitelist)
-                if hasattr(llm_data, 'tags') and llm_data.tags:
-                    filtered_tags = [tag for tag in llm_data.tags if tag in ALLOWED_TAGS]
-                    if filtered_tags:
-                        await self.anki_client.update_note_tags(note.note_id, filtered_tags)
-                
                 # Сохраняем в кеш обработки
                 self._cache_processing_result(note, input_data, True)
                 
-                progress.update(True)
-                return ProcessingResult(
+                return ProcessingResult.model_construct(
                     note_id=note.note_id,
                     success=True,
                     updated_fields=field_updates,
                     audio_file=audio_filename
                 )
             else:
-                progress.update(False)
-                return ProcessingResult(
+                return ProcessingResult.model_construct(
                     note_id=note.note_id,
                     success=False,
                     error="Ошибка обновления заметки"
@@ -313,8 +444,7 @@ class ProcessingPipeline:
                 
         except Exception as e:
             logger.error(f"Ошибка обработки заметки {note.note_id}: {e}")
-            progress.update(False)
-            return ProcessingResult(
+            return ProcessingResult.model_construct(
                 note_id=note.note_id,
                 success=False,
                 error=str(e)
@@ -324,22 +454,41 @@ class ProcessingPipeline:
         """Извлечь входные данные из заметки."""
         input_data = {}
         
-        for field_name, field_config in config.fields.items():
-            if field_config.mode == FieldMode.INPUT:
-                value = note.fields.get(field_name, "").strip()
-                if not value:
-                    logger.warning(f"Пустое INPUT поле {field_name} в заметке {note.note_id}")
-                    return None
-                input_data[field_name.lower()] = value
-        
-        # Специальные имена для совместимости
-        if "expression" in input_data:
-            input_data["word"] = input_data["expression"]
-        if "sentence" in input_data and not input_data["sentence"]:
-            input_data["sentence"] = input_data.get("word", "")
+        # Список INPUT полей и их ключи (Expression -> word) посчитаны один раз
+        # для типа заметки. Пустые INPUT поля не допускаются, поэтому
+        # подставлять значения по умолчанию не нужно
+        for field_name, key in config.input_keys:
+            value = note.fields.get(field_name, "").strip()
+            if not value:
+                logger.warning(f"Пустое INPUT поле {field_name} в заметке {note.note_id}")
+                return None
+            input_data[key] = value
         
         return input_data if input_data else None
     
+    def _check_note_skip(
+        self,
+        note: AnkiNote,
+        input_data: Optional[Dict[str, str]]
+    ) -> Optional[ProcessingResult]:
+        """Результат для заметки, которую не нужно обрабатывать, иначе None."""
+        if not input_data:
+            return ProcessingResult.model_construct(
+                note_id=note.note_id,
+                success=False,
+                error="Отсутствуют входные данные"
+            )
+        
+        # Проверяем кеш
+        if self._is_note_already_processed(note, input_data):
+            return ProcessingResult.model_construct(
+                note_id=note.note_id,
+                success=True,
+                error="Уже обработано (из кеша)"
+            )
+        
+        return None
+    
     def _is_note_already_processed(self, note: AnkiNote, input_data: Dict[str, str]) -> bool:
         """Проверить, была ли заметка уже обработана."""
         if "all" in self.force_regenerate:
@@ -359,44 +508,168 @@ class ProcessingPipeline:
     ) -> Optional[LLMWordData]:
         """Генерировать данные через LLM."""
         # Проверяем кеш
-        cached_data = self.cache_manager.get_cached_openai_data(word, sentence)
+        cached_data = self.cache_manager.get_cached_openai_data(
+            word, sentence, self.openai_client.model, system_prompt
+        )
         if cached_data and not self._should_regenerate_llm():
             return cached_data
         
-        # Генерируем новые данные
-        async with self.semaphore_pool.get_semaphore("openai_text"):
-            llm_data = await self.openai_client.generate_word_data(
-                word, sentence, system_prompt
-            )
+        # Заметки с тем же словом и предложением ждут уже идущую генерацию,
+        # а не отправляют свой запрос
+        inflight_key = generate_llm_cache_key(
+            word, sentence, self.openai_client.model, system_prompt
+        )
+        pending = self._llm_inflight.get(inflight_key)
+        if pending is not None:
+            return await asyncio.shield(pending)
         
-        if llm_data:
-            self.cache_manager.set_cached_openai_data(word, sentence, llm_data)
+        future = asyncio.get_running_loop().create_future()
+        self._llm_inflight[inflight_key] = future
+        llm_data = None
+        try:
+            # Генерируем новые данные
+            if self.llm_rows_per_call > 1:
+                llm_data = await self._enqueue_llm_request(word, sentence, system_prompt)
+            else:
+                async with self._openai_semaphore:
+                    llm_data = await self.openai_client.generate_word_data(
+                        word, sentence, system_prompt
+                    )
+            
+            if llm_data:
+                self.cache_manager.set_cached_openai_data(
+                    word, sentence, self.openai_client.model, system_prompt, llm_data
+                )
+        finally:
+            # Ожидающие получают результат и при ошибке или отмене
+            del self._llm_inflight[inflight_key]
+            future.set_result(llm_data)
         
         return llm_data
     
+    async def _enqueue_llm_request(
+        self,
+        word: str,
+        sentence: str,
+        system_prompt: str
+    ) -> Optional[LLMWordData]:
+        """
+        Поставить слово в очередь на генерацию LLM.
+        
+        Очередь отправляется одним запросом, когда набирается llm_rows_per_call
+        заметок или LLM_BATCH_MAX_INPUT_TOKENS входных токенов, либо истекает
+        LLM_BATCH_LINGER.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._llm_queue.append((word, sentence, future))
+        self._llm_queue_tokens += self.openai_client.estimate_tokens(word + " " + sentence)
+        
+        if (
+            len(self._llm_queue) >= self.llm_rows_per_call
+            or self._llm_queue_tokens >= LLM_BATCH_MAX_INPUT_TOKENS
+        ):
+            self._flush_llm_queue(system_prompt)
+        elif self._llm_flush_handle is None:
+            self._llm_flush_handle = loop.call_later(
+                LLM_BATCH_LINGER, self._flush_llm_queue, system_prompt
+            )
+        
+        return await future
+    
+    def _flush_llm_queue(self, system_prompt: str):
+        """Отправить накопленную очередь в LLM."""
+        if self._llm_flush_handle is not None:
+            self._llm_flush_handle.cancel()
+            self._llm_flush_handle = None
+        
+        batch, self._llm_queue = self._llm_queue, []
+        self._llm_queue_tokens = 0
+        if not batch:
+            return
+        
+        task = asyncio.create_task(self._run_llm_batch(batch, system_prompt))
+        self._llm_tasks.add(task)
+        task.add_done_callback(self._llm_tasks.discard)
+    
+    async def _run_llm_batch(
+        self,
+        batch: List[Tuple[str, str, asyncio.Future]],
+        system_prompt: str
+    ):
+        """Сгенерировать данные для батча и раздать результаты ожидающим заметкам."""
+        results: List[Optional[LLMWordData]] = []
+        try:
+            async with self._openai_semaphore:
+                results = await self.openai_client.generate_word_data_batch(
+                    [(word, sentence) for word, sentence, _ in batch],
+                    system_prompt
+                )
+        except Exception as e:
+            logger.error(f"Ошибка батчевой генерации LLM: {e}")
+        finally:
+            # Ожидающие заметки должны получить ответ даже при ошибке или отмене
+            results = list(results) + [None] * (len(batch) - len(results))
+            for (_, _, future), llm_data in zip(batch, results):
+                if not future.done():
+                    future.set_result(llm_data)
+    
     async def _generate_audio(self, word: str, note_id: int) -> Optional[str]:
         """Генерировать аудио файл."""
-        async with self.semaphore_pool.get_semaphore("openai_tts"):
-            filename = await self.voice_client.synthesize_speech(word, note_id)
+        async with self._tts_semaphore:
+            result = await self.voice_client.synthesize_speech_data(word, note_id)
         
-        if filename:
-            # Сохраняем файл в Anki
-            audio_path = self.voice_client.audio_dir / filename
-            if audio_path.exists():
-                with open(audio_path, 'rb') as f:
-                    audio_data = f.read()
-                await self.anki_client.store_media_file(filename, audio_data)
+        if not result:
+            return None
         
+        # Сохраняем файл в Anki теми же байтами, что записаны на диск
+        filename, audio_data = result
+        await self.anki_client.store_media_file(filename, audio_data)
         return filename
     
+    async def _prewarm_frequencies(self, notes: List[AnkiNote], note_type_name: str):
+        """Посчитать частотность всех слов колоды одним проходом в отдельном потоке."""
+        config = NOTE_TYPE_CONFIGS[note_type_name]
+        if "FreqSort" not in config.fields:
+            return
+        
+        # Ранг ищется по лемме из ответа LLM, поэтому прогреваем ее, если ответ
+        # уже в кеше; для остальных заметок лемма неизвестна - берем само слово
+        use_llm_cache = not self._should_regenerate_llm()
+        system_prompt = config.llm_prompt
+        words = []
+        for note in notes:
+            input_data = self._extract_input_data(note, config)
+            if not input_data or "word" not in input_data:
+                continue
+            lemma = None
+            if use_llm_cache:
+                cached = self.cache_manager.get_cached_openai_data(
+                    input_data["word"],
+                    input_data.get("sentence", ""),
+                    self.openai_client.model,
+                    system_prompt
+                )
+                lemma = cached.lemma if cached is not None else None
+            words.append(lemma or input_data["word"])
+        try:
+            count = await asyncio.to_thread(self.freq_calculator.prewarm, words)
+            logger.debug("Частотность посчитана заранее для {} слов", count)
+        except Exception as e:
+            # Без прогрева частотность посчитается по ходу обработки
+            logger.warning(f"Не удалось заранее посчитать частотность: {e}")
+    
     async def _get_frequency_rank(self, word: str, lemma: str = None) -> str:
         """Получить ранг частотности слова."""
         # Проверяем кеш
         cached_freq = self.cache_manager.get_cached_frequency(word, lemma)
-        if cached_freq is not None:
+        # Значения старого формата ("zipf 5.23", без ведущих нулей) пересчитываем
+        if cached_freq is not None and is_frequency_key(cached_freq):
             return cached_freq
         
-        # Вычисляем частотность
+        # Вычисляем частотность сразу, не дожидаясь прогрева всей колоды:
+        # уже прогретое слово берется из кеша калькулятора, остальное
+        # считается здесь же (повторный расчет того же слова безвреден)
         freq_rank = self.freq_calculator.get_frequency_rank(word, lemma)
         
         # Сохраняем в кеш
@@ -414,10 +687,8 @@ class ProcessingPipeline:
         """Построить словарь обновлений полей."""
         updates = {}
         
-        for field_name, field_config in config.fields.items():
-            if field_config.mode != FieldMode.GENERATE:
-                continue
-            
+        # Список GENERATE полей посчитан один раз для типа заметки
+        for field_name, llm_key, is_str in config.generate_specs:
             # Специальная логика для аудио
             if field_name == "ExpressionAudio" and audio_filename:
                 updates[field_name] = f"[sound:{audio_filename}]"
@@ -429,10 +700,10 @@ class ProcessingPipeline:
                 continue
             
             # Маппинг через llm_key
-            if field_config.llm_key and hasattr(llm_data, field_config.llm_key):
-                value = getattr(llm_data, field_config.llm_key)
+            if llm_key is not None:
+                value = getattr(llm_data, llm_key, None)
                 if value:
-                    updates[field_name] = str(value)
+                    updates[field_name] = value if is_str else str(value)
         
         return updates
     
@@ -451,20 +722,17 @@ class ProcessingPipeline:
         success: bool
     ):
         """Сохранить результат обработки в кеш."""
-        from .utils import generate_cache_key
-        import time
-        
+        # note_id добавляется в ключ самим CacheManager
         cache_key = generate_cache_key(
-            str(note.note_id), 
             input_data.get("word", ""), 
             input_data.get("sentence", "")
         )
         
-        result = ProcessingResult(
+        result = ProcessingResult.model_construct(
             note_id=note.note_id,
-            success=success
+            success=success,
+            created_at=time.time()
         )
-        result.created_at = time.time()
         
         self.cache_manager.set_cached_processing_result(
             note.note_id, cache_key, result
@@ -472,12 +740,16 @@ class ProcessingPipeline:
     
     async def _save_all_caches(self):
         """Сохранить все кеши."""
-        await asyncio.gather(
-            self.cache_manager.save_openai_cache(),
-            self.cache_manager.save_freq_cache(),
-            self.cache_manager.save_processing_cache(),
-            return_exceptions=True
-        )
+        await self.cache_manager.save_all()
+    
+    async def _flush_caches_periodically(self):
+        """Дописывать новые записи журналов OpenAI и обработки раз в CACHE_FLUSH_INTERVAL."""
+        while True:
+            await asyncio.sleep(CACHE_FLUSH_INTERVAL)
+            await asyncio.gather(
+                self.cache_manager.save_openai_cache(),
+                self.cache_manager.save_processing_cache()
+            )
     
     async def get_deck_preview(self, deck_name: str, note_type_name: str) -> dict:
         """Получить превью колоды для валидации."""
@@ -491,17 +763,27 @@ class ProcessingPipeline:
             }
         
         # Валидация
-        validation_report = self.validator.validate_notes(notes, note_type_name)
+        validation_report, valid_notes = self.validator.validate_and_filter(
+            notes, note_type_name
+        )
+        
+        # Сколько валидных заметок будет взято из кеша LLM
+        llm_cache_hits = self._count_llm_cache_hits(valid_notes, note_type_name)
         
         # Выборка для превью
         sample_notes = notes[:5]  # Первые 5 заметок
+        input_fields = NOTE_TYPE_CONFIGS[note_type_name].input_fields
         
         return {
             "total_notes": len(notes),
             "sample_notes": [
                 {
                     "note_id": note.note_id,
-                    "fields": dict(list(note.fields.items())[:3])  # Первые 3 поля
+                    # Только INPUT поля, обрезанные для компактного вывода
+                    "fields": {
+                        name: note.fields.get(name, "")[:PREVIEW_FIELD_LENGTH]
+                        for name in input_fields
+                    }
                 }
                 for note in sample_notes
             ],
@@ -509,5 +791,25 @@ class ProcessingPipeline:
                 "valid_notes": validation_report.valid_notes,
                 "invalid_notes": validation_report.invalid_notes,
                 "error_count": len(validation_report.errors)
-            }
+            },
+            "llm_cache_hits": llm_cache_hits
         }
+    
+    def _count_llm_cache_hits(self, valid_notes: List[AnkiNote], note_type_name: str) -> int:
+        """Посчитать валидные заметки, для которых ответ LLM уже есть в кеше."""
+        if self._should_regenerate_llm():
+            return 0
+        
+        config = NOTE_TYPE_CONFIGS[note_type_name]
+        system_prompt = config.llm_prompt
+        hits = 0
+        for note in valid_notes:
+            input_data = self._extract_input_data(note, config)
+            if input_data and self.cache_manager.get_cached_openai_data(
+                input_data["word"],
+                input_data["sentence"],
+                self.openai_client.model,
+                system_prompt
+            ):
+                hits += 1
+        return hits
@@ -2,10 +2,12 @@
 
 from __future__ import annotations
 
+import functools
+import sys
 from enum import Enum
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 
 
 class FieldMode(str, Enum):
@@ -15,8 +17,15 @@ class FieldMode(str, Enum):
     SKIP = "SKIP"
 
 
+# Ключи входных данных, под которыми пайплайн ждет INPUT поля с другим именем
+INPUT_KEY_ALIASES: Dict[str, str] = {"expression": "word"}
+
+
 class NoteTypeFieldConfig(BaseModel):
     """Конфигурация поля типа заметки."""
+    # Конфигурации - общие константы модуля config
+    model_config = ConfigDict(frozen=True)
+    
     mode: FieldMode
     llm_key: Optional[str] = None  # ключ в JSON ответе LLM
     description: Optional[str] = None
@@ -24,11 +33,81 @@ class NoteTypeFieldConfig(BaseModel):
 
 class NoteTypeConfig(BaseModel):
     """Конфигурация типа заметки."""
+    model_config = ConfigDict(frozen=True)
+    
     name: str
     fields: Dict[str, NoteTypeFieldConfig]
-    llm_prompt: str
-    input_fields: List[str] = Field(default_factory=list)
-    generate_fields: List[str] = Field(default_factory=list)
+    llm_prompt_factory: Callable[[], str]  # промпт собирается при первом использовании
+    input_fields: Tuple[str, ...] = ()
+    generate_fields: Tuple[str, ...] = ()
+    
+    @field_validator("fields")
+    @classmethod
+    def _intern_field_names(
+        cls, fields: Dict[str, NoteTypeFieldConfig]
+    ) -> Dict[str, NoteTypeFieldConfig]:
+        """Интернировать имена полей: они постоянно используются как ключи."""
+        return {sys.intern(name): field for name, field in fields.items()}
+    
+    @functools.cached_property
+    def input_keys(self) -> Tuple[Tuple[str, str], ...]:
+        """INPUT поля в порядке конфигурации: (имя поля, ключ во входных данных)."""
+        return tuple(
+            (field_name, INPUT_KEY_ALIASES.get(field_name.lower(), field_name.lower()))
+            for field_name, field_config in self.fields.items()
+            if field_config.mode == FieldMode.INPUT
+        )
+    
+    @functools.cached_property
+    def generate_specs(self) -> Tuple[Tuple[str, Optional[str], bool], ...]:
+        """
+        GENERATE поля в порядке конфигурации: (имя поля, llm_key, значение - строка).
+        
+        llm_key проверен по полям LLMWordData: для ключей, которых в ответе
+        нет, вместо него None.
+        """
+        llm_fields = LLMWordData.model_fields
+        specs = []
+        for field_name, field_config in self.fields.items():
+            if field_config.mode != FieldMode.GENERATE:
+                continue
+            llm_field = llm_fields.get(field_config.llm_key)
+            if llm_field is None:
+                specs.append((field_name, None, False))
+            else:
+                specs.append((field_name, field_config.llm_key, llm_field.annotation is str))
+        return tuple(specs)
+    
+    @functools.cached_property
+    def required_fields(self) -> FrozenSet[str]:
+        """Имена всех полей конфигурации, которые должны быть у типа заметки в Anki."""
+        return frozenset(self.fields)
+    
+    @functools.cached_property
+    def validation_checks(self) -> Tuple[Tuple[str, FieldMode, bool], ...]:
+        """
+        Проверяемые поля в порядке конфигурации: (имя поля, режим, должно быть заполнено).
+        
+        SKIP поля не проверяются и сюда не попадают.
+        """
+        return tuple(
+            (field_name, field_config.mode, field_config.mode == FieldMode.INPUT)
+            for field_name, field_config in self.fields.items()
+            if field_config.mode != FieldMode.SKIP
+        )
+    
+    @property
+    def llm_prompt(self) -> str:
+        """Системный промпт для LLM."""
+        return self.llm_prompt_factory()
+    
+    def effective_generate_fields(self, processing: ProcessingConfig) -> FrozenSet[str]:
+        """GENERATE поля, которые реально будут заполнены с учетом skip_* настроек."""
+        return frozenset(
+            field_name for field_name in self.generate_fields
+            if not (processing.skip_audio and field_name.endswith("Audio"))
+            and not (processing.skip_frequency and field_name == "FreqSort")
+        )
 
 
 class OpenAIConfig(BaseModel):
@@ -48,12 +127,15 @@ class AnkiConfig(BaseModel):
     url: str = "http://127.0.0.1:8765"
     batch_size: int = 50
     timeout: float = 30.0
+    max_concurrency: int = 4
 
 
 class CacheConfig(BaseModel):
     """Конфигурация кеширования."""
     dir: str = "cache"
     audio_dir: str = "cache/audio"
+    pretty: bool = False  # форматировать JSON кеша отступами
+    tts_failure_ttl: float = 300.0  # сколько секунд не повторять неудавшийся синтез
 
 
 class ProcessingConfig(BaseModel):
@@ -63,10 +145,15 @@ class ProcessingConfig(BaseModel):
     skip_audio: bool = False
     skip_frequency: bool = False
     skip_invalid_notes: bool = True
+    llm_rows_per_call: int = 4  # сколько заметок отправлять в одном запросе к LLM
+    note_workers: int = 50  # сколько заметок обрабатывается одновременно
 
 
 class LLMWordData(BaseModel):
     """Структура ответа LLM для словарных данных."""
+    # Экземпляры разделяются через кеш - запрещаем изменение
+    model_config = ConfigDict(frozen=True)
+    
     definition: str = Field(..., description="Короткое английское определение")
     definition_ru: str = Field(..., description="Русский перевод")
     ipa: str = Field(..., description="IPA транскрипция")
@@ -82,7 +169,7 @@ class LLMWordData(BaseModel):
 
 class AnkiNote(BaseModel):
     """Представление заметки Anki."""
-    model_config = {"protected_namespaces": ()}
+    model_config = ConfigDict(protected_namespaces=(), frozen=True)
     
     note_id: int
     model_name: str
@@ -53,7 +53,9 @@ def validate_cache_config() -> CacheConfig:
     try:
         config = CacheConfig(
             dir=cache_dir,
-            audio_dir=f"{cache_dir}/audio"
+            audio_dir=f"{cache_dir}/audio",
+            pretty=get_env_var("CACHE_PRETTY", "false", False).lower() in ("1", "true", "yes"),
+            tts_failure_ttl=float(get_env_var("TTS_FAILURE_TTL", "300", False))
         )
         # Создаем директории если не существуют
         Path(config.dir).mkdir(parents=True, exist_ok=True)
@@ -70,7 +72,9 @@ ANKI_CONFIG = validate_anki_config()
 CACHE_CONFIG = validate_cache_config()
 
 PROCESSING_CONFIG = ProcessingConfig(
-    skip_invalid_notes=True  # По умолчанию пропускаем невалидные заметки
+    skip_invalid_notes=True,  # По умолчанию пропускаем невалидные заметки
+    llm_rows_per_call=max(1, int(get_env_var("LLM_ROWS_PER_CALL", "4", False))),
+    note_workers=max(1, int(get_env_var("NOTE_WORKERS", "50", False)))
 )
 
 # Настройка логирования
@@ -1,15 +1,19 @@
 """Утилиты для обработки ошибок, retry логики и батчинга."""
 
 import asyncio
+import collections
+import functools
+import hashlib
+import html
+import random
+import re
 import time
-from typing import Any, Callable, List, TypeVar
+from typing import Any, Callable
 
 from loguru import logger
 
 from .config import RETRY_CONFIG
 
-T = TypeVar('T')
-
 
 async def retry_with_backoff(
     func: Callable,
@@ -38,13 +42,14 @@ async def retry_with_backoff(
                 
             # Проверяем специальные коды ошибок
             error_str = str(e).lower()
-            if "429" in error_str or "rate limit" in error_str:
-                delay = min(base_delay * (exponential_base ** attempt), max_delay)
-                logger.warning(f"Rate limit для {func.__name__}, повтор через {delay}s")
+            status_code = getattr(e, 'status_code', None)
+            if status_code == 429 or "429" in error_str or "rate limit" in error_str:
+                delay = _retry_delay(e, attempt, base_delay, max_delay, exponential_base)
+                logger.warning(f"Rate limit для {func.__name__}, повтор через {delay:.1f}s")
                 await asyncio.sleep(delay)
-            elif "5" in str(getattr(e, 'status_code', '')) and str(getattr(e, 'status_code', '')).startswith('5'):
-                delay = min(base_delay * (exponential_base ** attempt), max_delay)
-                logger.warning(f"Серверная ошибка для {func.__name__}, повтор через {delay}s")
+            elif isinstance(status_code, int) and 500 <= status_code < 600:
+                delay = _retry_delay(e, attempt, base_delay, max_delay, exponential_base)
+                logger.warning(f"Серверная ошибка для {func.__name__}, повтор через {delay:.1f}s")
                 await asyncio.sleep(delay)
             else:
                 # Для других ошибок не повторяем
@@ -54,15 +59,136 @@ async def retry_with_backoff(
     raise last_exception
 
 
-def batch_items(items: List[T], batch_size: int) -> List[List[T]]:
-    """Разделить список на батчи заданного размера."""
-    if batch_size <= 0:
-        raise ValueError("batch_size должен быть больше 0")
+def _retry_delay(
+    error: Exception,
+    attempt: int,
+    base_delay: float,
+    max_delay: float,
+    exponential_base: float
+) -> float:
+    """
+    Задержка перед повтором.
+    
+    Если сервер прислал Retry-After в секундах, ждем указанное время, но не
+    дольше max_delay. Иначе - экспоненциальная задержка с полным jitter, чтобы
+    параллельные запросы, получившие 429 одновременно, не повторялись тоже
+    одновременно.
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    retry_after = headers.get('Retry-After') if headers is not None else None
+    if retry_after:
+        try:
+            return min(max_delay, max(0.0, float(retry_after)))
+        except ValueError:
+            # Retry-After в формате HTTP-даты не разбираем
+            pass
+    
+    cap = min(base_delay * (exponential_base ** attempt), max_delay)
+    return random.uniform(0, cap)
+
+
+def async_cached(ttl: float):
+    """
+    Кешировать результат async метода по аргументам на ttl секунд.
+    
+    Параллельные вызовы с одинаковыми аргументами ждут один общий запрос
+    (single-flight), ошибки не кешируются.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(self, *args):
+            cache = self.__dict__.setdefault("_async_cache", {})
+            key = (func.__name__, args)
+            now = time.monotonic()
+            
+            entry = cache.get(key)
+            if entry is not None:
+                expires_at, future = entry
+                if not future.done() or now < expires_at:
+                    return await asyncio.shield(future)
+            
+            future = asyncio.ensure_future(func(self, *args))
+            cache[key] = (now + ttl, future)
+            
+            def evict_failed(done: asyncio.Future):
+                # Ошибку или отмену не кешируем: запись убирается, как только
+                # запрос завершился, даже если первый вызывающий уже отменен
+                failed = done.cancelled() or done.exception() is not None
+                if failed and cache.get(key, (None, None))[1] is done:
+                    del cache[key]
+            
+            future.add_done_callback(evict_failed)
+            return await asyncio.shield(future)
+        
+        return wrapper
+    return decorator
+
+
+class ResizableSemaphore:
+    """
+    Семафор, лимит которого можно менять во время работы.
+    
+    asyncio.Semaphore не позволяет сменить лимит без правки приватного _value,
+    поэтому счетчик занятых слотов и очередь ожидающих хранятся явно.
+    release и set_limit синхронные: освобождение слота не может быть
+    прервано отменой задачи, и слоты не теряются.
+    """
     
-    batches = []
-    for i in range(0, len(items), batch_size):
-        batches.append(items[i:i + batch_size])
-    return batches
+    def __init__(self, limit: int):
+        self._limit = max(1, limit)
+        self._active = 0
+        self._waiters: collections.deque = collections.deque()
+    
+    @property
+    def limit(self) -> int:
+        """Текущий лимит одновременных операций."""
+        return self._limit
+    
+    async def acquire(self):
+        """Занять слот, дождавшись освобождения, если лимит исчерпан."""
+        if self._active < self._limit and not self._waiters:
+            self._active += 1
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже был выдан этой задаче - возвращаем его следующему
+                self._active -= 1
+                self._wake_waiters()
+            elif future in self._waiters:
+                # Отмененный future мог уже забрать из очереди _wake_waiters
+                self._waiters.remove(future)
+            raise
+    
+    def release(self):
+        """Освободить слот и разбудить ожидающих, если есть свободные слоты."""
+        self._active -= 1
+        self._wake_waiters()
+    
+    def set_limit(self, limit: int):
+        """Сменить лимит (не меньше 1); при увеличении ожидающие сразу получают слоты."""
+        self._limit = max(1, limit)
+        self._wake_waiters()
+    
+    def _wake_waiters(self):
+        """Выдать свободные слоты ожидающим в порядке очереди."""
+        while self._waiters and self._active < self._limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                # Слот занимается сразу, чтобы его не перехватил новый acquire
+                self._active += 1
+                future.set_result(None)
+    
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
 
 
 class AsyncSemaphorePool:
@@ -70,16 +196,20 @@ class AsyncSemaphorePool:
     
     def __init__(self, limits: dict[str, int]):
         self._semaphores = {
-            name: asyncio.Semaphore(limit) 
+            name: ResizableSemaphore(limit) 
             for name, limit in limits.items()
         }
     
-    def get_semaphore(self, name: str) -> asyncio.Semaphore:
+    def get_semaphore(self, name: str) -> ResizableSemaphore:
         """Получить семафор по имени."""
         if name not in self._semaphores:
             raise ValueError(f"Семафор {name} не найден")
         return self._semaphores[name]
     
+    def set_limit(self, name: str, limit: int):
+        """Изменить лимит семафора, например при снижении скорости из-за rate limit."""
+        self.get_semaphore(name).set_limit(limit)
+    
     async def run_with_semaphore(self, name: str, coro):
         """Выполнить корутину с ограничением семафора."""
         async with self.get_semaphore(name):
@@ -88,59 +218,81 @@ class AsyncSemaphorePool:
 
 def generate_cache_key(*args) -> str:
     """Генерация стабильного ключа кеша из аргументов."""
+    try:
+        return _cached_cache_key(*args)
+    except TypeError:
+        # Нехешируемые аргументы (list, dict) считаем без мемоизации
+        return _build_cache_key(args)
+
+
+# Размер ключа кеша LLM: 128 бит достаточно против коллизий и вдвое короче sha256
+LLM_CACHE_KEY_BYTES = 16
+
+
+def generate_llm_cache_key(word: str, sentence: str, model: str, system_prompt: str) -> str:
+    """
+    Ключ кеша ответа LLM.
+    
+    Учитывает модель и версию промпта: смена любого из них инвалидирует кеш.
+    """
+    parts = (
+        _normalize_text(word),
+        _normalize_text(sentence),
+        model,
+        prompt_version(system_prompt)
+    )
+    return hashlib.blake2b(
+        "\x1f".join(parts).encode("utf-8"), digest_size=LLM_CACHE_KEY_BYTES
+    ).hexdigest()
+
+
+@functools.lru_cache(maxsize=8)
+def prompt_version(system_prompt: str) -> str:
+    """Короткий хеш промпта, используемый как его версия."""
+    return hashlib.blake2b(system_prompt.encode("utf-8"), digest_size=8).hexdigest()
+
+
+# HTML разметка полей Anki и знаки препинания не меняют смысл входных данных LLM
+_HTML_TAG_RE = re.compile(r"<[^>]*>")
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+
+
+def _normalize_text(text: str) -> str:
+    """Нормализовать текст для ключа кеша: разметка, пунктуация, регистр и пробелы не важны."""
+    text = html.unescape(_HTML_TAG_RE.sub(" ", text))
+    return " ".join(_PUNCTUATION_RE.sub(" ", text).split()).casefold()
+
+
+# typed=True и аргументы по отдельности: иначе равные 1, 1.0 и True
+# попадали бы в одну запись кеша и ключ зависел бы от первого вызова
+@functools.lru_cache(maxsize=100_000, typed=True)
+def _cached_cache_key(*args) -> str:
+    """Мемоизированная сборка ключа для хешируемых аргументов."""
+    return _build_cache_key(args)
+
+
+def _build_cache_key(args: tuple) -> str:
+    """Собрать ключ кеша из кортежа аргументов."""
+    # Нормализация (нижний регистр, "_" вместо пробелов) применяется к каждой
+    # части отдельно, и итоговая строка не проходит повторно. Формат ключа
+    # совпадает с прежним: по нему ищутся сохраненные результаты обработки
     key_parts = []
+    append = key_parts.append
     for arg in args:
-        if isinstance(arg, (str, int, float)):
-            key_parts.append(str(arg))
+        if isinstance(arg, str):
+            append(arg.lower().replace(" ", "_"))
+        elif isinstance(arg, (int, float)):
+            # Пробелов в числах нет; lower нужен для bool ("True")
+            append(str(arg).lower())
         elif isinstance(arg, (list, tuple)):
-            key_parts.append("|".join(str(x) for x in arg))
+            append("|".join(str(x) for x in arg).lower().replace(" ", "_"))
         elif isinstance(arg, dict):
             sorted_items = sorted(arg.items())
-            key_parts.append("|".join(f"{k}:{v}" for k, v in sorted_items))
+            append("|".join(f"{k}:{v}" for k, v in sorted_items).lower().replace(" ", "_"))
         else:
-            key_parts.append(str(hash(str(arg))))
-    
-    return "_".join(key_parts).lower().replace(" ", "_")
-
-
-class ProgressTracker:
-    """Отслеживание прогресса обработки."""
+            append(str(hash(str(arg))))
     
-    def __init__(self, total: int, description: str = "Обработка"):
-        self.total = total
-        self.processed = 0
-        self.errors = 0
-        self.start_time = time.time()
-        self.description = description
-    
-    def update(self, success: bool = True):
-        """Обновить счетчики."""
-        self.processed += 1
-        if not success:
-            self.errors += 1
-        
-        if self.processed % 10 == 0 or self.processed == self.total:
-            self._log_progress()
-    
-    def _log_progress(self):
-        """Логирование прогресса."""
-        elapsed = time.time() - self.start_time
-        rate = self.processed / elapsed if elapsed > 0 else 0
-        
-        logger.info(
-            f"{self.description}: {self.processed}/{self.total} "
-            f"({self.processed/self.total*100:.1f}%) "
-            f"Ошибок: {self.errors} "
-            f"Скорость: {rate:.1f}/сек"
-        )
-    
-    def finish(self):
-        """Финальная статистика."""
-        elapsed = time.time() - self.start_time
-        logger.info(
-            f"{self.description} завершена: {self.processed}/{self.total} "
-            f"за {elapsed:.1f}сек. Ошибок: {self.errors}"
-        )
+    return "_".join(key_parts)
 
 
 async def run_with_timeout(coro, timeout: float):
@@ -152,43 +304,17 @@ async def run_with_timeout(coro, timeout: float):
         raise
 
 
+# Символы, недопустимые в именах файлов, и пробельные последовательности
+_UNSAFE_FILENAME_CHARS_RE = re.compile(r'[<>:"/\\|?*]')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
 def safe_filename(text: str, max_length: int = 100) -> str:
     """Создать безопасное имя файла из текста."""
-    import re
-    
     # Убираем опасные символы
-    safe = re.sub(r'[<>:"/\\|?*]', '_', text)
+    safe = _UNSAFE_FILENAME_CHARS_RE.sub('_', text)
     # Убираем лишние пробелы и символы
-    safe = re.sub(r'\s+', '_', safe.strip())
-    # Ограничиваем длину
-    if len(safe) > max_length:
-        safe = safe[:max_length]
-    
-    return safe.lower()
+    safe = _WHITESPACE_RE.sub('_', safe.strip())
+    # Ограничиваем длину (срез не копирует строку, если она короче)
+    return safe[:max_length].lower()
 
-
-class RateLimiter:
-    """Ограничитель скорости запросов."""
-    
-    def __init__(self, max_requests: int, time_window: float):
-        self.max_requests = max_requests
-        self.time_window = time_window
-        self.requests = []
-    
-    async def acquire(self):
-        """Получить разрешение на запрос."""
-        now = time.time()
-        
-        # Убираем старые запросы
-        self.requests = [req_time for req_time in self.requests 
-                        if now - req_time < self.time_window]
-        
-        # Проверяем лимит
-        if len(self.requests) >= self.max_requests:
-            sleep_time = self.time_window - (now - self.requests[0])
-            if sleep_time > 0:
-                await asyncio.sleep(sleep_time)
-                return await self.acquire()
-        
-        self.requests.append(now)
-        return True
@@ -1,6 +1,8 @@
 """Модуль для валидации заметок и полей."""
 
-from typing import List, Optional
+import collections
+import functools
+from typing import AsyncIterator, List, Optional, Tuple
 
 from loguru import logger
 
@@ -14,6 +16,17 @@ from .schemas import (
 )
 
 
+@functools.lru_cache(maxsize=32)
+def _check_compatibility(
+    anki_fields: Tuple[str, ...],
+    note_type_name: str
+) -> Tuple[bool, Tuple[str, ...]]:
+    """Сравнить поля Anki с конфигурацией (результат кешируется)."""
+    config = NOTE_TYPE_CONFIGS[note_type_name]
+    missing_fields = tuple(config.required_fields.difference(anki_fields))
+    return len(missing_fields) == 0, missing_fields
+
+
 class NoteValidator:
     """Валидатор заметок Anki."""
     
@@ -35,26 +48,63 @@ class NoteValidator:
         Returns:
             ValidationReport с результатами валидации
         """
+        report, _ = self.validate_and_filter(notes, note_type_name)
+        return report
+    
+    def validate_and_filter(
+        self,
+        notes: List[AnkiNote],
+        note_type_name: str
+    ) -> Tuple[ValidationReport, List[AnkiNote]]:
+        """
+        Валидировать заметки и отобрать валидные за один проход.
+        
+        Returns:
+            (ValidationReport, список заметок, прошедших валидацию)
+        """
         if note_type_name not in self.note_type_configs:
             raise ValueError(f"Неизвестный тип заметки: {note_type_name}")
         
         config = self.note_type_configs[note_type_name]
         errors = []
-        valid_count = 0
+        valid_notes = []
         
         for note in notes:
             note_errors = self._validate_single_note(note, config)
             if note_errors:
                 errors.extend(note_errors)
+                logger.debug(f"Заметка {note.note_id} не прошла валидацию: {len(note_errors)} ошибок")
             else:
-                valid_count += 1
+                valid_notes.append(note)
         
-        return ValidationReport(
+        report = ValidationReport(
             total_notes=len(notes),
-            valid_notes=valid_count,
-            invalid_notes=len(notes) - valid_count,
+            valid_notes=len(valid_notes),
+            invalid_notes=len(notes) - len(valid_notes),
             errors=errors
         )
+        return report, valid_notes
+    
+    async def iter_validation_errors(
+        self,
+        note_batches: AsyncIterator[List[AnkiNote]],
+        note_type_name: str
+    ) -> AsyncIterator[Tuple[int, List[ValidationError]]]:
+        """
+        Валидировать заметки по мере их поступления.
+        
+        Yields:
+            (ID заметки, ошибки) для каждой невалидной заметки
+        """
+        if note_type_name not in self.note_type_configs:
+            raise ValueError(f"Неизвестный тип заметки: {note_type_name}")
+        
+        config = self.note_type_configs[note_type_name]
+        async for notes in note_batches:
+            for note in notes:
+                note_errors = self._validate_single_note(note, config)
+                if note_errors:
+                    yield note.note_id, note_errors
     
     def _validate_single_note(
         self, 
@@ -75,20 +125,20 @@ class NoteValidator:
             ))
             return errors  # Если модель не совпадает, дальше не проверяем
         
-        # Проверяем каждое поле по конфигурации
-        for field_name, field_config in config.fields.items():
-            current_value = note.fields.get(field_name, "").strip()
-            
-            # Валидация по режиму поля
-            field_error = self._validate_field(
-                note.note_id,
-                field_name,
-                current_value,
-                field_config.mode
-            )
+        # Проверяем поля по заранее собранному списку: INPUT должны быть
+        # заполнены, GENERATE - пустыми, SKIP в список не входят
+        fields_get = note.fields.get
+        for field_name, expected_mode, must_be_filled in config.validation_checks:
+            current_value = fields_get(field_name, "").strip()
             
-            if field_error:
-                errors.append(field_error)
+            # Ошибку со всеми подробностями строим только при нарушении
+            if bool(current_value) != must_be_filled:
+                errors.append(self._validate_field(
+                    note.note_id,
+                    field_name,
+                    current_value,
+                    expected_mode
+                ))
         
         return errors
     
@@ -125,33 +175,6 @@ class NoteValidator:
         # SKIP поля не валидируем
         return None
     
-    def filter_valid_notes(
-        self, 
-        notes: List[AnkiNote], 
-        note_type_name: str
-    ) -> List[AnkiNote]:
-        """
-        Отфильтровать только валидные заметки.
-        
-        Returns:
-            Список заметок, прошедших валидацию
-        """
-        if note_type_name not in self.note_type_configs:
-            logger.error(f"Неизвестный тип заметки: {note_type_name}")
-            return []
-        
-        config = self.note_type_configs[note_type_name]
-        valid_notes = []
-        
-        for note in notes:
-            errors = self._validate_single_note(note, config)
-            if not errors:
-                valid_notes.append(note)
-            else:
-                logger.debug(f"Заметка {note.note_id} не прошла валидацию: {len(errors)} ошибок")
-        
-        return valid_notes
-    
     def print_validation_report(self, report: ValidationReport) -> str:
         """Создать текстовый отчет о валидации."""
         lines = [
@@ -166,21 +189,26 @@ class NoteValidator:
             lines.append(f"\n=== ОШИБКИ ВАЛИДАЦИИ ({len(report.errors)}) ===")
             
             # Группируем ошибки по заметкам
-            errors_by_note = {}
+            errors_by_note = collections.defaultdict(list)
             for error in report.errors:
-                if error.note_id not in errors_by_note:
-                    errors_by_note[error.note_id] = []
                 errors_by_note[error.note_id].append(error)
             
-            for note_id, note_errors in errors_by_note.items():
-                lines.append(f"\nЗаметка {note_id}:")
-                for error in note_errors:
-                    lines.append(f"  - {error.field_name} ({error.expected_mode.value}): {error.error_message}")
-                    if error.current_value:
-                        lines.append(f"    Текущее значение: '{error.current_value[:100]}...'")
+            lines.extend(
+                self.format_note_errors(note_id, note_errors)
+                for note_id, note_errors in errors_by_note.items()
+            )
         
         return "\n".join(lines)
     
+    def format_note_errors(self, note_id: int, errors: List[ValidationError]) -> str:
+        """Создать текстовый блок с ошибками одной заметки."""
+        lines = [f"\nЗаметка {note_id}:"]
+        for error in errors:
+            lines.append(f"  - {error.field_name} ({error.expected_mode.value}): {error.error_message}")
+            if error.current_value:
+                lines.append(f"    Текущее значение: '{error.current_value[:100]}...'")
+        return "\n".join(lines)
+    
     def get_field_requirements(self, note_type_name: str) -> dict:
         """Получить требования к полям для типа заметки."""
         if note_type_name not in self.note_type_configs:
@@ -221,30 +249,14 @@ class NoteValidator:
         if note_type_name not in self.note_type_configs:
             return False, [f"Неизвестный тип заметки: {note_type_name}"]
         
-        config = self.note_type_configs[note_type_name]
-        required_fields = set(config.fields.keys())
-        available_fields = set(anki_fields)
-        
-        missing_fields = list(required_fields - available_fields)
-        
-        return len(missing_fields) == 0, missing_fields
+        compatible, missing_fields = _check_compatibility(tuple(anki_fields), note_type_name)
+        return compatible, list(missing_fields)
     
-    def check_processing_readiness(
-        self, 
-        notes: List[AnkiNote], 
-        note_type_name: str
-    ) -> tuple[bool, str]:
-        """
-        Проверить готовность заметок к обработке.
-        
-        Returns:
-            (готовность, сообщение)
-        """
-        if not notes:
+    def readiness_from_report(self, report: ValidationReport) -> tuple[bool, str]:
+        """Готовность к обработке по уже построенному отчету валидации."""
+        if report.total_notes == 0:
             return False, "Нет заметок для обработки"
         
-        report = self.validate_notes(notes, note_type_name)
-        
         if report.invalid_notes == 0:
             return True, f"Все {report.total_notes} заметок готовы к обработке"
         else:
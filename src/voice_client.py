@@ -1,7 +1,11 @@
 """Клиент для синтеза речи через OpenAI TTS."""
 
+import asyncio
+import hashlib
+import os
+import time
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 from loguru import logger
 from openai import AsyncOpenAI
@@ -9,6 +13,9 @@ from openai import AsyncOpenAI
 from .settings import CACHE_CONFIG, OPENAI_CONFIG
 from .utils import retry_with_backoff, safe_filename
 
+# Длина хеша в имени аудио файла: 128 бит исключают совпадения имен
+AUDIO_NAME_DIGEST_BYTES = 16
+
 
 class VoiceClientError(Exception):
     """Ошибка клиента синтеза речи."""
@@ -18,8 +25,10 @@ class VoiceClientError(Exception):
 class VoiceClient:
     """Клиент для генерации аудио через OpenAI TTS."""
     
-    def __init__(self):
-        self.client = AsyncOpenAI(
+    def __init__(self, client: Optional[AsyncOpenAI] = None):
+        # Клиент OpenAI можно передать снаружи, чтобы TTS и генерация текста
+        # делили один пул соединений с API
+        self.client = client or AsyncOpenAI(
             api_key=OPENAI_CONFIG.api_key,
             base_url=OPENAI_CONFIG.base_url,
             timeout=OPENAI_CONFIG.timeout
@@ -28,6 +37,17 @@ class VoiceClient:
         self.voice = OPENAI_CONFIG.tts_voice
         self.audio_dir = Path(CACHE_CONFIG.audio_dir)
         self.audio_dir.mkdir(parents=True, exist_ok=True)
+        # Идущие синтезы по имени файла: один текст озвучивается один раз
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Фоновая запись на диск: синтез не ждет файловых операций.
+        # Пока файл в очереди, его данные отдаются из _pending_writes
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._pending_writes: Dict[str, bytes] = {}
+        # Неудавшиеся синтезы по имени файла: время ошибки. В течение TTL
+        # тот же текст не отправляется в API повторно
+        self._failed: Dict[str, float] = {}
+        self._failure_ttl = CACHE_CONFIG.tts_failure_ttl
     
     async def synthesize_speech(
         self, 
@@ -44,18 +64,74 @@ class VoiceClient:
         Returns:
             Имя сохраненного аудио файла или None при ошибке
         """
+        result = await self.synthesize_speech_data(text, note_id)
+        return result[0] if result else None
+    
+    async def synthesize_speech_data(
+        self,
+        text: str,
+        note_id: Optional[int] = None
+    ) -> Optional[Tuple[str, bytes]]:
+        """
+        Синтезировать речь и вернуть вместе с именем файла его содержимое.
+        
+        Содержимое нужно для отправки в Anki, и так его не приходится
+        повторно читать с диска сразу после записи.
+        
+        Returns:
+            (имя файла, аудио данные) или None при ошибке
+        """
         if not text or not text.strip():
             logger.warning("Пустой текст для синтеза речи")
             return None
         
         # Генерируем имя файла
         filename = self._generate_filename(text, note_id)
+        
+        # Недавняя ошибка для этого текста: не повторяем запрос до истечения TTL
+        failed_at = self._failed.get(filename)
+        if failed_at is not None:
+            if time.monotonic() - failed_at < self._failure_ttl:
+                logger.debug("Пропуск синтеза после недавней ошибки: {}", filename)
+                return None
+            del self._failed[filename]
+        
+        # Тот же текст в другой заметке ждет уже идущий синтез
+        pending = self._inflight.get(filename)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[filename] = future
+        result = None
+        try:
+            result = await self._synthesize_to_file(text, filename)
+            if result is None:
+                self._failed[filename] = time.monotonic()
+        finally:
+            del self._inflight[filename]
+            future.set_result(result)
+        
+        return result
+    
+    async def _synthesize_to_file(
+        self,
+        text: str,
+        filename: str
+    ) -> Optional[Tuple[str, bytes]]:
+        """Взять аудио из файла или синтезировать и сохранить его."""
         file_path = self.audio_dir / filename
         
-        # Проверяем, есть ли уже файл
-        if file_path.exists():
-            logger.debug(f"Аудио файл уже существует: {filename}")
-            return filename
+        # Файл синтезирован, но еще не записан
+        pending = self._pending_writes.get(filename)
+        if pending is not None:
+            return filename, pending
+        
+        # Проверяем, есть ли уже файл; чтение с диска не блокирует цикл событий
+        existing = await asyncio.to_thread(self._read_existing, file_path)
+        if existing is not None:
+            logger.debug("Аудио файл уже существует: {}", filename)
+            return filename, existing
         
         try:
             # Генерируем аудио
@@ -67,17 +143,75 @@ class VoiceClient:
                 logger.error(f"Не удалось сгенерировать аудио для '{text}'")
                 return None
             
-            # Сохраняем файл
-            with open(file_path, 'wb') as f:
-                f.write(audio_data)
-            
-            logger.debug(f"Аудио сохранено: {filename}")
-            return filename
+            # Данные уже есть в памяти, поэтому запись уходит в фон
+            self._enqueue_write(filename, audio_data)
+            return filename, audio_data
             
         except Exception as e:
             logger.error(f"Ошибка синтеза речи для '{text}': {e}")
             return None
     
+    def _enqueue_write(self, filename: str, audio_data: bytes):
+        """Поставить аудио в очередь фоновой записи на диск."""
+        if self._write_queue is None:
+            self._write_queue = asyncio.Queue()
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.create_task(self._drain_writes())
+        self._pending_writes[filename] = audio_data
+        self._write_queue.put_nowait(filename)
+    
+    async def _drain_writes(self):
+        """Записывать файлы из очереди по одному в отдельном потоке."""
+        while True:
+            filename = await self._write_queue.get()
+            try:
+                await asyncio.to_thread(
+                    self._write_file,
+                    self.audio_dir / filename,
+                    self._pending_writes[filename]
+                )
+                logger.debug("Аудио сохранено: {}", filename)
+            except Exception as e:
+                logger.error(f"Ошибка записи аудио {filename}: {e}")
+            finally:
+                del self._pending_writes[filename]
+                self._write_queue.task_done()
+    
+    @staticmethod
+    def _read_existing(file_path: Path) -> Optional[bytes]:
+        """Прочитать готовый аудио файл или вернуть None, если его нет."""
+        try:
+            return file_path.read_bytes()
+        except FileNotFoundError:
+            return None
+    
+    @staticmethod
+    def _write_file(file_path: Path, audio_data: bytes):
+        """
+        Записать файл через временный: недописанный при сбое файл
+        иначе считался бы готовым аудио при следующем запуске.
+        """
+        temp_path = file_path.with_suffix(".tmp")
+        try:
+            temp_path.write_bytes(audio_data)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+    
+    async def flush(self):
+        """Дождаться записи на диск всех синтезированных файлов."""
+        if self._write_queue is not None:
+            await self._write_queue.join()
+    
+    async def aclose(self):
+        """Дописать очередь файлов и остановить фоновую запись."""
+        await self.flush()
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            await asyncio.gather(self._writer_task, return_exceptions=True)
+            self._writer_task = None
+    
     async def _create_speech_request(self, text: str) -> bytes:
         """Выполнить запрос к TTS API."""
         try:
@@ -95,14 +229,21 @@ class VoiceClient:
             raise VoiceClientError(f"Ошибка синтеза: {e}")
     
     def _generate_filename(self, text: str, note_id: Optional[int] = None) -> str:
-        """Сгенерировать имя файла для аудио."""
-        # Используем безопасное имя на основе текста
-        safe_text = safe_filename(text, max_length=50)
+        """
+        Сгенерировать имя файла для аудио.
         
-        if note_id:
-            return f"{safe_text}_{note_id}.mp3"
-        else:
-            return f"{safe_text}.mp3"
+        Имя определяется текстом, моделью и голосом, а не заметкой: одно слово
+        в разных заметках и колодах использует один файл. note_id не влияет
+        на имя и оставлен для совместимости вызовов.
+        """
+        # Читаемая часть имени на основе текста
+        safe_text = safe_filename(text, max_length=50)
+        # Хеш различает тексты, совпавшие после safe_filename, и смену голоса
+        digest = hashlib.blake2b(
+            "\x1f".join((text, self.model, self.voice)).encode("utf-8"),
+            digest_size=AUDIO_NAME_DIGEST_BYTES
+        ).hexdigest()
+        return f"{safe_text}_{digest}.mp3"
     
     def get_audio_field_value(self, filename: str) -> str:
         """Получить значение для поля аудио в Anki."""
@@ -130,64 +271,26 @@ class VoiceClient:
         # Голоса OpenAI TTS (по документации)
         return ["alloy", "echo", "fable", "onyx", "nova", "shimmer"]
     
-    def get_cache_size(self) -> tuple[int, float]:
-        """Получить размер кеша аудио файлов."""
-        count = 0
-        total_size = 0.0
-        
-        if self.audio_dir.exists():
-            for file_path in self.audio_dir.glob("*.mp3"):
-                count += 1
-                total_size += file_path.stat().st_size
-        
-        return count, total_size / (1024 * 1024)  # МБ
-    
-    def cleanup_cache(self, max_files: int = 1000) -> int:
-        """Очистить старые файлы из кеша."""
+    def _scan_audio_files(self) -> list[tuple[str, int, float]]:
+        """Аудио файлы кеша: (имя, размер, время последнего использования)."""
         if not self.audio_dir.exists():
-            return 0
+            return []
         
-        files = list(self.audio_dir.glob("*.mp3"))
-        if len(files) <= max_files:
-            return 0
-        
-        # Сортируем по времени изменения (старые сначала)
-        files.sort(key=lambda f: f.stat().st_mtime)
-        
-        files_to_delete = files[:len(files) - max_files]
-        deleted = 0
-        
-        for file_path in files_to_delete:
-            try:
-                file_path.unlink()
-                deleted += 1
-            except Exception as e:
-                logger.warning(f"Не удалось удалить {file_path}: {e}")
-        
-        logger.info(f"Удалено {deleted} старых аудио файлов")
-        return deleted
+        # os.scandir отдает stat из того же чтения каталога, без Path на файл
+        entries = []
+        with os.scandir(self.audio_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".mp3") and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_size, max(stat.st_atime, stat.st_mtime)))
+        return entries
     
-    async def batch_synthesize(
-        self,
-        text_pairs: list[tuple[str, int]],  # (text, note_id)
-        concurrency_limit: int = 5
-    ) -> dict[int, Optional[str]]:
-        """Батчевый синтез аудио для списка текстов."""
-        import asyncio
-        
-        semaphore = asyncio.Semaphore(concurrency_limit)
-        results = {}
-        
-        async def process_text(text: str, note_id: int):
-            async with semaphore:
-                filename = await self.synthesize_speech(text, note_id)
-                results[note_id] = filename
-                return note_id, filename
-        
-        tasks = [
-            process_text(text, note_id) 
-            for text, note_id in text_pairs
-        ]
+    def get_cache_size(self) -> tuple[int, float]:
+        """
+        Получить размер кеша аудио файлов.
         
-        await asyncio.gather(*tasks, return_exceptions=True)
-        return results
+        Файлы из очереди записи не учитываются: перед подсчетом вызовите flush().
+        """
+        entries = self._scan_audio_files()
+        total_size = sum(size for _, size, _ in entries)
+        return len(entries), total_size / (1024 * 1024)  # МБ
@@ -0,0 +1,50 @@
+"""Тесты утилит."""
+
+import asyncio
+import unittest
+
+from src.utils import ResizableSemaphore
+
+
+class ResizableSemaphoreTest(unittest.IsolatedAsyncioTestCase):
+    """ResizableSemaphore: слоты не теряются при отмене ожидающих."""
+    
+    async def test_cancel_then_release_in_same_tick(self):
+        semaphore = ResizableSemaphore(1)
+        await semaphore.acquire()
+        
+        waiter = asyncio.create_task(semaphore.acquire())
+        await asyncio.sleep(0)  # waiter встал в очередь
+        
+        # В том же шаге цикла: cancel сразу отменяет future ожидающего,
+        # и _wake_waiters забирает его из очереди раньше обработчика отмены
+        waiter.cancel()
+        semaphore.release()
+        
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(semaphore._active, 0)
+        self.assertEqual(len(semaphore._waiters), 0)
+        
+        # Слот свободен для следующего
+        await asyncio.wait_for(semaphore.acquire(), timeout=1)
+    
+    async def test_cancel_after_grant_passes_slot_on(self):
+        semaphore = ResizableSemaphore(1)
+        await semaphore.acquire()
+        
+        first = asyncio.create_task(semaphore.acquire())
+        second = asyncio.create_task(semaphore.acquire())
+        await asyncio.sleep(0)
+        
+        semaphore.release()  # слот выдан first
+        first.cancel()
+        
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+        await asyncio.wait_for(second, timeout=1)
+        self.assertEqual(semaphore._active, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()